@@ -0,0 +1,232 @@
+import sys
+import time
+import numpy as np
+
+# Vectorized BC3 and BC4 block compression for generated textures
+# Endpoints are the per block min and max, which is fast and good enough for
+# roughness and emission maps, decoders are included to measure the error
+
+DXGI_FORMAT_BC3_UNORM = 77
+DXGI_FORMAT_BC4_UNORM = 80
+
+def to_blocks(arr):
+    """Split an HxW or HxWxC array into (blocks, 16[, C]), edge padding to a multiple of 4."""
+    height, width = arr.shape[:2]
+    pad_h, pad_w = -height % 4, -width % 4
+    if pad_h or pad_w:
+        arr = np.pad(arr, ((0, pad_h), (0, pad_w)) + ((0, 0),) * (arr.ndim - 2), mode='edge')
+    height, width = arr.shape[:2]
+    extra = arr.shape[2:]
+    blocks = arr.reshape(height // 4, 4, width // 4, 4, *extra).swapaxes(1, 2)
+    return blocks.reshape((height // 4) * (width // 4), 16, *extra)
+
+def from_blocks(blocks, width, height):
+    """Inverse of to_blocks, cropping the padding back off."""
+    bw, bh = (width + 3) // 4, (height + 3) // 4
+    extra = blocks.shape[2:]
+    arr = blocks.reshape(bh, bw, 4, 4, *extra).swapaxes(1, 2).reshape(bh * 4, bw * 4, *extra)
+    return arr[:height, :width]
+
+def pack_indices(indices, bits):
+    shifts = np.arange(16, dtype=np.uint64) * np.uint64(bits)
+    return (indices.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+def unpack_indices(packed, bits):
+    shifts = np.arange(16, dtype=np.uint64) * np.uint64(bits)
+    return ((packed[:, None] >> shifts) & np.uint64((1 << bits) - 1)).astype(np.int32)
+
+def le_bytes(values, count):
+    shifts = np.arange(count, dtype=np.uint64) * np.uint64(8)
+    return ((values.astype(np.uint64)[:, None] >> shifts) & np.uint64(0xFF)).astype(np.uint8)
+
+def from_le_bytes(data):
+    shifts = np.arange(data.shape[1], dtype=np.uint64) * np.uint64(8)
+    return (data.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+def encode_bc4_blocks(values):
+    """Encode (n, 16) uint8 values into (n, 8) BC4 blocks using the 8 value mode."""
+    v = values.astype(np.int32)
+    hi = v.max(axis=1)
+    lo = v.min(axis=1)
+    span = np.maximum(hi - lo, 1)[:, None]
+
+    # Step along the palette from hi (step 0) to lo (step 7), then map steps to
+    # BC4 indices: 0 is red0, 1 is red1, 2-7 are the interpolated values
+    steps = ((hi[:, None] - v) * 14 + span) // (span * 2)
+    indices = np.where(steps == 0, 0, np.where(steps == 7, 1, steps + 1))
+    # Flat blocks have red0 == red1, index 0 is red0 in either mode
+    indices[hi == lo] = 0
+
+    out = np.empty((len(values), 8), dtype=np.uint8)
+    out[:, 0] = hi
+    out[:, 1] = lo
+    out[:, 2:] = le_bytes(pack_indices(indices, 3), 6)
+    return out
+
+# The 48 index bits of a BC4 block are handled as four 12 bit groups of four indices
+GROUP_DIGITS = (np.arange(4096, dtype=np.int32)[:, None] >> (np.arange(4, dtype=np.int32) * 3)) & 7
+
+def index_groups(data):
+    """Split (n, 6) BC4 index bytes into (n, 4) 12 bit groups."""
+    b = data.astype(np.uint16)
+    groups = np.empty((len(data), 4), dtype=np.uint16)
+    groups[:, 0] = b[:, 0] | (b[:, 1] & 0xF) << 8
+    groups[:, 1] = b[:, 1] >> 4 | b[:, 2] << 4
+    groups[:, 2] = b[:, 3] | (b[:, 4] & 0xF) << 8
+    groups[:, 3] = b[:, 4] >> 4 | b[:, 5] << 4
+    return groups
+
+def group_bytes(groups):
+    """Inverse of index_groups."""
+    out = np.empty((len(groups), 6), dtype=np.uint8)
+    out[:, 0] = groups[:, 0] & 0xFF
+    out[:, 1] = groups[:, 0] >> 8 | (groups[:, 1] & 0xF) << 4
+    out[:, 2] = groups[:, 1] >> 4
+    out[:, 3] = groups[:, 2] & 0xFF
+    out[:, 4] = groups[:, 2] >> 8 | (groups[:, 3] & 0xF) << 4
+    out[:, 5] = groups[:, 3] >> 4
+    return out
+
+palette_table = None
+
+def bc4_palette_table():
+    """Every BC4 palette, 8 values for each (red0, red1) pair, built on first use."""
+    global palette_table
+    if palette_table is None:
+        r0 = np.arange(256, dtype=np.int32).repeat(256)[:, None]
+        r1 = np.tile(np.arange(256, dtype=np.int32), 256)[:, None]
+        w = np.arange(1, 7, dtype=np.int32)[None, :]
+        eight = np.concatenate([r0, r1, ((7 - w) * r0 + w * r1 + 3) // 7], axis=1)
+        w = np.arange(1, 5, dtype=np.int32)[None, :]
+        six = np.concatenate([r0, r1, ((5 - w) * r0 + w * r1 + 2) // 5, np.zeros_like(r0), np.full_like(r0, 255)], axis=1)
+        palette_table = np.where(r0 > r1, eight, six).astype(np.uint8).reshape(-1)
+    return palette_table
+
+def decode_bc4_blocks(blocks):
+    # Look every pixel up in its block's palette in a single gather
+    indices = GROUP_DIGITS[index_groups(blocks[:, 2:8])].reshape(len(blocks), 16)
+    indices += (blocks[:, 0].astype(np.int32) << 11 | blocks[:, 1].astype(np.int32) << 3)[:, None]
+    return bc4_palette_table()[indices]
+
+def invert_group_table(remap):
+    return (remap[GROUP_DIGITS] << (np.arange(4, dtype=np.int32) * 3)).sum(axis=1).astype(np.uint16)
+
+# Inverting a BC4 block swaps and inverts the endpoints, which keeps the block's
+# mode, then remaps the indices so every pixel points at its inverted value
+INVERT_EIGHT = invert_group_table(np.array([1, 0, 7, 6, 5, 4, 3, 2], dtype=np.int32))
+INVERT_SIX = invert_group_table(np.array([1, 0, 5, 4, 3, 2, 7, 6], dtype=np.int32))
+
+def invert_bc4_blocks(blocks):
+    """Invert (n, 8) BC4 blocks, or BC3 alpha blocks, without decoding them."""
+    r0 = blocks[:, 0]
+    r1 = blocks[:, 1]
+    groups = index_groups(blocks[:, 2:8])
+    groups = np.where((r0 > r1)[:, None], INVERT_EIGHT[groups], INVERT_SIX[groups])
+    out = np.empty_like(blocks)
+    out[:, 0] = 255 - r1
+    out[:, 1] = 255 - r0
+    out[:, 2:8] = group_bytes(groups)
+    return out
+
+def decode_bc2_alpha_blocks(blocks):
+    """Decode (n, 8) explicit BC2 alpha blocks into (n, 16) values."""
+    alpha = np.empty((len(blocks), 16), dtype=np.uint8)
+    alpha[:, 0::2] = (blocks & 0xF) * 17
+    alpha[:, 1::2] = (blocks >> 4) * 17
+    return alpha
+
+def pack565(rgb):
+    return ((rgb[:, 0] >> 3) << 11) | ((rgb[:, 1] >> 2) << 5) | (rgb[:, 2] >> 3)
+
+def expand565(packed):
+    r = (packed >> 11) & 0x1F
+    g = (packed >> 5) & 0x3F
+    b = packed & 0x1F
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=1)
+
+def encode_bc1_color_blocks(rgb):
+    """Encode (n, 16, 3) uint8 colors into (n, 8) four color BC1 blocks."""
+    c = rgb.astype(np.int32)
+    hi = c.max(axis=1)
+    lo = c.min(axis=1)
+    # Inset the bounding box to reduce the error of the outer colors
+    inset = (hi - lo) >> 4
+    c0 = pack565(hi - inset)
+    c1 = pack565(lo + inset)
+    # The box is per channel so c0 >= c1 always holds, keeping four color mode
+
+    # Project every color onto the endpoint line and snap to the four palette entries
+    p0 = expand565(c0)
+    p1 = expand565(c1)
+    axis = p1 - p0
+    length = np.maximum((axis * axis).sum(axis=1), 1)[:, None]
+    t = ((c - p0[:, None, :]) * axis[:, None, :]).sum(axis=2)
+    steps = np.clip((t * 6 + length) // (length * 2), 0, 3)
+    indices = np.array([0, 2, 3, 1], dtype=np.int32)[steps]
+    indices[c0 == c1] = 0
+
+    out = np.empty((len(rgb), 8), dtype=np.uint8)
+    out[:, 0:2] = le_bytes(c0, 2)
+    out[:, 2:4] = le_bytes(c1, 2)
+    out[:, 4:8] = le_bytes(pack_indices(indices, 2), 4)
+    return out
+
+def decode_bc1_color_blocks(blocks):
+    c0 = from_le_bytes(blocks[:, 0:2]).astype(np.int32)
+    c1 = from_le_bytes(blocks[:, 2:4]).astype(np.int32)
+    p0 = expand565(c0)
+    p1 = expand565(c1)
+    palette = np.stack([p0, p1, (2 * p0 + p1) // 3, (p0 + 2 * p1) // 3], axis=1)
+    indices = unpack_indices(from_le_bytes(blocks[:, 4:8]), 2)
+    return np.take_along_axis(palette, indices[:, :, None], axis=1).astype(np.uint8)
+
+def encode_bc4(arr):
+    """Encode an HxW uint8 array as BC4 data."""
+    return encode_bc4_blocks(to_blocks(arr)).tobytes()
+
+def encode_bc3(arr):
+    """Encode an HxWx4 uint8 RGBA array as BC3 data."""
+    blocks = to_blocks(arr)
+    out = np.empty((len(blocks), 16), dtype=np.uint8)
+    out[:, 0:8] = encode_bc4_blocks(blocks[:, :, 3])
+    out[:, 8:16] = encode_bc1_color_blocks(blocks[:, :, 0:3])
+    return out.tobytes()
+
+def decode_bc4(data, width, height):
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 8)
+    return from_blocks(decode_bc4_blocks(blocks), width, height)
+
+def decode_bc3(data, width, height):
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+    rgba = np.empty((len(blocks), 16, 4), dtype=np.uint8)
+    rgba[:, :, 3] = decode_bc4_blocks(blocks[:, 0:8])
+    rgba[:, :, 0:3] = decode_bc1_color_blocks(blocks[:, 8:16])
+    return from_blocks(rgba, width, height)
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255 ** 2 / mse)
+
+if __name__ == '__main__':
+    # Report encoding speed, size and error for the given images
+    from PIL import Image
+
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} image [image ...]')
+        sys.exit(1)
+
+    for fname in sys.argv[1:]:
+        with Image.open(fname) as img:
+            rgba = np.asarray(img.convert('RGBA'))
+        height, width = rgba.shape[:2]
+        for name, source, encode, decode in (
+                ('BC4', rgba[:, :, 3], encode_bc4, decode_bc4),
+                ('BC3', rgba, encode_bc3, decode_bc3)):
+            start = time.perf_counter()
+            data = encode(source)
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            error = psnr(source, decode(data, width, height))
+            print(f'{fname}: {name} {width}x{height} {source.nbytes / 1e6 / elapsed:.1f} MB/s, '
+                  f'{source.nbytes} -> {len(data)} bytes, PSNR {error:.2f} dB')
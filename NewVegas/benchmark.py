@@ -0,0 +1,378 @@
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import platform
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import usdagen
+import nifscan
+import hashindex
+import hashmap
+import xxhash
+
+# Times each stage of usdagen.py on a synthetic texture and mesh corpus, generated
+# offline from a seed so every run and machine sees the same files
+# Stages run the same functions usdagen.py does:
+#   walk      scan_textures over the textures folder
+#   hash      hashing every texture into a fresh hash index
+#   nif       update_nifcache parsing every .nif on the process pool
+#   generate  write_usda generating every texture from scratch
+#   write     write_usda with hashes and nothing to generate, just the USDA itself
+
+# Bump when the corpus layout changes, so cached corpora are rebuilt
+CORPUS_VERSION = 1
+FILES_PER_FOLDER = 200
+# Digests that depend on how textures are generated, not just on the corpus
+GENERATED_DIGESTS = ('generate_usda', 'generated')
+
+# Format name, FourCC, DXGI format, bytes per 4x4 block or bits per pixel
+formats = {
+'DXT1': (b'DXT1', None, 8),
+'DXT5': (b'DXT5', None, 16),
+'BC7': (b'DX10', 98, 16), # DX10 header, BC7_UNORM
+'RGBA': (None, None, 32) # Uncompressed B8G8R8A8
+}
+
+# Weights for each texture kind, normal maps are mostly DXT5 like the game's
+diffuse_formats = {'DXT1': 5, 'DXT5': 3, 'BC7': 1, 'RGBA': 1}
+normal_formats = {'DXT5': 6, 'DXT1': 2, 'BC7': 1, 'RGBA': 1}
+mask_formats = {'DXT5': 3, 'DXT1': 1, 'RGBA': 1}
+resolutions = {32: 3, 64: 4, 128: 2, 256: 1}
+
+def choose(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+def write_dds(fname, fmt, width, height, rng):
+    """Write a DDS of random pixels with a full mip chain."""
+    fourcc, dxgi_format, size = formats[fmt]
+    levels = []
+    w, h = width, height
+    while True:
+        if fourcc is None:
+            levels.append(w * h * size // 8)
+        else:
+            levels.append(((w+3)//4) * ((h+3)//4) * size)
+        if w == 1 and h == 1:
+            break
+        w, h = max(1, w // 2), max(1, h // 2)
+
+    header = bytearray(128)
+    header[0:4] = b'DDS '
+    if fourcc is None:
+        flags = 0x2100F # Caps, Height, Width, Pitch, PixelFormat, MipMaps
+        pitch = width * 4
+        pf_flags = 0x41 # RGB, AlphaPixels
+        masks = (32, 0x00FF0000, 0x0000FF00, 0x000000FF, 0xFF000000)
+    else:
+        flags = 0xA1007 # Caps, Height, Width, PixelFormat, MipMaps, LinearSize
+        pitch = levels[0]
+        pf_flags = 0x4 # FourCC
+        masks = (0, 0, 0, 0, 0)
+        header[84:88] = fourcc
+    struct.pack_into('<7I', header, 4, 124, flags, height, width, pitch, 1, len(levels))
+    struct.pack_into('<2I', header, 76, 32, pf_flags)
+    struct.pack_into('<5I', header, 88, *masks)
+    struct.pack_into('<I', header, 108, 0x401008) # Complex, Texture, MipMaps
+    if dxgi_format is not None:
+        header += struct.pack('<5I', dxgi_format, 3, 0, 1, 0) # Texture2D
+    with open(fname, 'wb') as f:
+        f.write(header)
+        f.write(rng.randbytes(sum(levels)))
+
+def sized_string(data):
+    return struct.pack('<I', len(data)) + data
+
+def write_nif(fname, texture_sets):
+    """Write a Fallout 3/New Vegas NIF holding only BSShaderTextureSet blocks, each one a root."""
+    blocks = [struct.pack('<i', len(textures)) + b''.join(sized_string(texture) for texture in textures) for textures in texture_sets]
+    with open(fname, 'wb') as f:
+        f.write(b'Gamebryo File Format, Version 20.2.0.7\n')
+        f.write(struct.pack('<IBII', nifscan.NIF_VERSION, 1, nifscan.NIF_USER_VERSION, len(blocks)))
+        # Bethesda stream header: version, then author, process script and export script
+        f.write(struct.pack('<I', 34))
+        for text in (b'benchmark', b'', b''):
+            f.write(struct.pack('<B', len(text) + 1) + text + b'\0')
+        # Block types, block type and size of each block, no strings or groups
+        f.write(struct.pack('<H', 1) + sized_string(b'BSShaderTextureSet'))
+        f.write(struct.pack(f'<{len(blocks)}H', *[0] * len(blocks)))
+        f.write(struct.pack(f'<{len(blocks)}I', *map(len, blocks)))
+        f.write(struct.pack('<III', 0, 0, 0))
+        f.write(b''.join(blocks))
+        f.write(struct.pack(f'<I{len(blocks)}i', len(blocks), *range(len(blocks))))
+
+def nif_path(path):
+    # NIFs store backslashed paths, sometimes with Data\ in front and in any case
+    return ('textures\\' + path.removeprefix('textures/').replace('/', '\\')).encode()
+
+def build_corpus(root, count, seed):
+    """Write at least count textures under root/textures and NIFs referencing some of them under root/meshes."""
+    rng = random.Random(seed)
+    dds_count = 0
+    nif_count = 0
+    materials = 0
+    folder = -1
+    nif_sets = []
+
+    def flush_nif():
+        nonlocal nif_count
+        if nif_sets:
+            write_nif(os.path.join(root, 'meshes', 'benchmark', f'dir{folder:04}', f'mesh{nif_count:05}.nif'), nif_sets)
+            nif_count += 1
+            nif_sets.clear()
+
+    while dds_count < count:
+        if dds_count // FILES_PER_FOLDER > folder:
+            flush_nif()
+            folder = dds_count // FILES_PER_FOLDER
+            for subdir in ('textures', 'meshes'):
+                os.makedirs(os.path.join(root, subdir, 'benchmark', f'dir{folder:04}'), exist_ok=True)
+        base = f'textures/benchmark/dir{folder:04}/mat{materials:05}'
+        materials += 1
+        width = choose(rng, resolutions)
+        height = width // rng.choice((1, 1, 2))
+        in_nif = rng.random() < 0.3
+
+        # Diffuse, some with a _d suffix, then the siblings usdagen.py looks for
+        textures = {'': base + ('_d' if rng.random() < 0.1 else '') + '.dds'}
+        if rng.random() < 0.7:
+            # Texture sets can name normal maps that siblings would never find
+            textures['_n'] = base + ('_nrm' if in_nif and rng.random() < 0.2 else '_n') + '.dds'
+        if rng.random() < 0.15:
+            textures['_g'] = base + '_g.dds'
+        if rng.random() < 0.15:
+            textures['_m'] = base + '_m.dds'
+        for suffix, path in textures.items():
+            fmt = choose(rng, {'': diffuse_formats, '_n': normal_formats}.get(suffix, mask_formats))
+            # Some glow masks are smaller than their diffuse
+            scale = 2 if suffix == '_g' and rng.random() < 0.3 else 1
+            write_dds(os.path.join(root, path), fmt, max(1, width // scale), max(1, height // scale), rng)
+            dds_count += 1
+
+        if in_nif:
+            texture_set = [nif_path(textures['']), b'', b'', b'', b'', b'']
+            for suffix, slot in (('_n', 1), ('_g', 2), ('_m', 5)):
+                if suffix in textures:
+                    texture_set[slot] = nif_path(textures[suffix])
+            if rng.random() < 0.2:
+                texture_set[0] = b'Data\\' + texture_set[0].upper()
+            nif_sets.append(texture_set)
+            if len(nif_sets) == 4:
+                flush_nif()
+    flush_nif()
+    return {'version': CORPUS_VERSION, 'seed': seed, 'files': count, 'dds': dds_count, 'nifs': nif_count, 'materials': materials}
+
+def load_corpus(root, count, seed):
+    """Reuse the corpus under root if it was built the same way, otherwise build it."""
+    info_path = os.path.join(root, 'corpus.json')
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        if info['version'] == CORPUS_VERSION and info['seed'] == seed and info['files'] == count:
+            return info
+    for subdir in ('textures', 'meshes'):
+        shutil.rmtree(os.path.join(root, subdir), ignore_errors=True)
+    print(f'Building corpus of {count} textures in {root}')
+    start = time.perf_counter()
+    info = build_corpus(root, count, seed)
+    print(f'Built {info["dds"]} textures and {info["nifs"]} NIFs in {time.perf_counter() - start:.1f}s')
+    os.makedirs(root, exist_ok=True)
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent='\t')
+    return info
+
+def digest(lines):
+    return xxhash.xxh3_64_hexdigest('\n'.join(sorted(lines)).encode('utf-8'))
+
+def usda_digest(fname):
+    # Materials are compared in sorted order, folder listing order depends on the filesystem
+    with open(fname) as f:
+        text = f.read().removesuffix(usdagen.USDA_FOOTER)
+    return digest(text.split('\t\tover "mat_')[1:])
+
+def generated_digest(folder):
+    # Contents of every generated texture along with where it was written
+    lines = []
+    for dirpath, _, files in os.walk(folder):
+        for file in files:
+            if file.endswith('.dds'):
+                fname = os.path.join(dirpath, file)
+                with open(fname, 'rb') as f:
+                    lines.append(f'{usdagen.relpathstd(fname, folder)} {xxhash.xxh3_64_hexdigest(f.read())}')
+    return digest(lines)
+
+def usda_args(output, jobs, no_generate, compress):
+    return argparse.Namespace(output=output, shard=False, no_generate=no_generate, dedup=False, jobs=jobs, hash_index='hashindex.db', block_compress=compress)
+
+def run_stages(root, ex, jobs, compress):
+    """Run every stage once in the working folder, returns the stage timings and output digests."""
+    txrdir = os.path.join(root, 'textures')
+    meshes = os.path.join(root, 'meshes')
+    # Start from nothing generated or hashed
+    shutil.rmtree('generated', ignore_errors=True)
+    for fname in ('hashindex.db', 'generate.usda', 'benchmark.usda'):
+        if os.path.exists(fname):
+            os.remove(fname)
+    stages = {}
+    digests = {}
+
+    def timed(name, items, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stages[name] = {'seconds': time.perf_counter() - start, 'items': items(result) if callable(items) else items}
+        return result
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ddslist, _ = timed('walk', lambda result: len(result[0]), usdagen.scan_textures, txrdir, root)
+
+            index = hashindex.HashIndex('hashindex.db')
+            def hash_all():
+                hashes = [f'{usdagen.relpathstd(fname, root)} {usdagen.calculate_hash(fname)}' for fname in ddslist]
+                index.save()
+                return hashes
+            usdagen.hash_index = index
+            digests['hashes'] = digest(timed('hash', len(ddslist), hash_all))
+
+            nifcache = {}
+            timed('nif', lambda result: result[0], usdagen.update_nifcache, meshes, nifcache, ex)
+            nifmap = usdagen.build_nifmap(nifcache)
+            digests['nifmap'] = xxhash.xxh3_64_hexdigest(json.dumps(nifmap, sort_keys=True).encode('utf-8'))
+
+            hashmaps = hashmap.HashMaps([])
+            if usdagen.have_PIL:
+                def count_generated():
+                    return sum(file.endswith('.dds') for _, _, files in os.walk('generated') for file in files)
+                timed('generate', lambda _: count_generated(), usdagen.write_usda, usda_args('generate.usda', jobs, False, compress), txrdir, root, nifmap, hashmaps, compress, ex)
+                digests['generate_usda'] = usda_digest('generate.usda')
+                digests['generated'] = generated_digest('generated')
+            timed('write', len(ddslist), usdagen.write_usda, usda_args('benchmark.usda', jobs, True, compress), txrdir, root, nifmap, hashmaps, compress)
+            digests['usda'] = usda_digest('benchmark.usda')
+    finally:
+        usdagen.hash_index = None
+    return stages, digests
+
+def check_golden(golden, counts, results, seed):
+    """Compare digests against the golden baseline, returns False on any mismatch."""
+    ok = True
+    # Generated textures are encoded differently with NumPy and block compression
+    same_settings = golden.get('numpy') == results['numpy'] and golden.get('compress') == results['compress']
+    if not same_settings:
+        print(f'Golden generated textures are from numpy={golden.get("numpy")} compress={golden.get("compress")}, not checking them')
+    for count in counts:
+        expected = golden.get('runs', {}).get(str(count))
+        if golden.get('seed') != seed or golden.get('corpus_version') != CORPUS_VERSION or expected is None:
+            print(f'{count} files: No golden baseline')
+            continue
+        if not same_settings:
+            expected = {name: value for name, value in expected.items() if name not in GENERATED_DIGESTS}
+        actual = results['runs'][str(count)]['digests']
+        mismatched = [name for name in expected if actual.get(name) != expected[name]]
+        if mismatched:
+            ok = False
+            print(f'{count} files: Golden mismatch in {", ".join(mismatched)}')
+        else:
+            print(f'{count} files: Matches golden {", ".join(expected)}')
+    return ok
+
+def compare(previous, results):
+    for count, run in results['runs'].items():
+        before = previous.get('runs', {}).get(count)
+        if before is None:
+            continue
+        for stage, timing in run['stages'].items():
+            if stage in before['stages']:
+                old = before['stages'][stage]['seconds']
+                new = timing['seconds']
+                print(f'{count} files {stage}: {old:.3f}s -> {new:.3f}s ({old / max(new, 1e-9):.2f}x)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks usdagen.py stages on a synthetic corpus of textures and NIFs.')
+    parser.add_argument('-n', '--files', help='Corpus sizes to benchmark, in textures', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('-c', '--corpus', help='Folder to build and keep corpora in', default='benchcorpus')
+    parser.add_argument('-o', '--output', help='JSON file to save results to', default='benchmark.json')
+    parser.add_argument('-j', '--jobs', help='Number of processes for NIF parsing and generation', type=int, default=os.cpu_count())
+    parser.add_argument('-r', '--repeat', help='Runs per corpus, the fastest time of each stage is kept', type=int, default=1)
+    parser.add_argument('-bc', '--block-compress', help='Block compress generated textures', action='store_true')
+    parser.add_argument('--seed', help='Seed the corpus is generated from', type=int, default=1)
+    parser.add_argument('--compare', help='Previous results to compare stage times against')
+    parser.add_argument('--golden', help='Golden digests of hashes, NIF texture sets, generated textures and USDA', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json'))
+    parser.add_argument('--update-golden', help='Save this run as the golden baseline instead of checking against it', action='store_true')
+    args = parser.parse_args()
+    compare_path = None if args.compare is None else os.path.abspath(args.compare)
+
+    # Normally set up by usdagen.py's main
+    usdagen.have_tqdm = False
+    usdagen.pbprint = print
+
+    compress = args.block_compress and usdagen.have_numpy
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'jobs': args.jobs,
+        'numpy': usdagen.have_numpy,
+        'PIL': usdagen.have_PIL,
+        'compress': compress,
+        'seed': args.seed,
+        'corpus_version': CORPUS_VERSION,
+        'runs': {}
+    }
+
+    # Generated textures and the USDA are written relative to the working folder like usdagen.py,
+    # which has to be entered before the workers start so they write there too
+    output = os.path.abspath(args.output)
+    golden_path = os.path.abspath(args.golden)
+    corpus = os.path.abspath(args.corpus)
+    os.makedirs(os.path.join(corpus, 'work'), exist_ok=True)
+    os.chdir(os.path.join(corpus, 'work'))
+
+    with ProcessPoolExecutor(args.jobs) as ex:
+        # Start the workers before anything is timed
+        list(ex.map(abs, range(args.jobs)))
+        for count in args.files:
+            root = os.path.join(corpus, f'n{count}')
+            info = load_corpus(root, count, args.seed)
+            run = {'dds': info['dds'], 'nifs': info['nifs'], 'materials': info['materials'], 'stages': {}}
+            for _ in range(args.repeat):
+                stages, run['digests'] = run_stages(root, ex, args.jobs, compress)
+                for name, timing in stages.items():
+                    if name not in run['stages'] or timing['seconds'] < run['stages'][name]['seconds']:
+                        run['stages'][name] = timing
+            results['runs'][str(count)] = run
+            for name, timing in run['stages'].items():
+                print(f'{count} files {name}: {timing["seconds"]:.3f}s, {timing["items"]} items, {timing["items"] / max(timing["seconds"], 1e-9):.0f}/s')
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent='\t')
+    print(f'Saved results to {output}')
+
+    if compare_path is not None:
+        with open(compare_path) as f:
+            compare(json.load(f), results)
+
+    if args.update_golden:
+        golden = {}
+        if os.path.exists(golden_path):
+            with open(golden_path) as f:
+                golden = json.load(f)
+        if (golden.get('seed') != args.seed or golden.get('corpus_version') != CORPUS_VERSION or
+            golden.get('numpy') != usdagen.have_numpy or golden.get('compress') != compress):
+            golden = {'seed': args.seed, 'corpus_version': CORPUS_VERSION, 'numpy': usdagen.have_numpy, 'compress': compress, 'runs': {}}
+        for count, run in results['runs'].items():
+            golden['runs'][count] = run['digests']
+        with open(golden_path, 'w') as f:
+            json.dump(golden, f, indent='\t')
+        print(f'Saved golden digests to {golden_path}')
+    elif os.path.exists(golden_path):
+        with open(golden_path) as f:
+            golden = json.load(f)
+        if not check_golden(golden, args.files, results, args.seed):
+            sys.exit(1)
@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import heapq
+import pstats
+import cProfile
+import threading
+import contextlib
+from concurrent.futures import Future
+
+# Per-stage metrics for usdagen.py --metrics-out: wall and CPU time, bytes read and written,
+# peak RSS and the slowest files of each stage, including jobs run on the process pool
+# Stages can nest, hash is timed inside materials and dds_write inside generate
+# Peak RSS of a stage needs the peak to be reset when it starts, which only Linux can do,
+# elsewhere only how much RSS grew over the stage is reported
+
+try:
+    import psutil
+    have_psutil = True
+except:
+    have_psutil = False
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ('nif', 'walk', 'materials', 'hash', 'generate', 'dds_write', 'finish')
+
+# Where stages and files are recorded in this process: the Metrics of a run in the main
+# process, Records while a worker runs a job, None when nothing is being recorded
+recorder = None
+
+def io_counters():
+    """Bytes read and written by this process so far, or None if unknown."""
+    if have_psutil:
+        counters = psutil.Process().io_counters()
+        # On Linux read_bytes only counts what reached the disk, not reads served from the page cache
+        return getattr(counters, 'read_chars', counters.read_bytes), getattr(counters, 'write_chars', counters.write_bytes)
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            fields = dict(line.split(b':') for line in f.read().splitlines())
+        return int(fields[b'rchar']), int(fields[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def rss():
+    """Resident memory of this process in bytes, or None if unknown."""
+    if have_psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """Make peak_rss() start again from the current resident memory, returns False if it can't."""
+    # Writing 5 resets VmHWM in /proc/self/status, Linux only
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    """Peak resident memory of this process in bytes since reset_peak_rss() or since it started, or None if unknown."""
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes everywhere but macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if have_psutil:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    return None
+
+class Timer:
+    def __init__(self, stage, name, counters):
+        self.stage = stage
+        self.name = name
+        self.counters = counters
+
+    def __enter__(self):
+        self.profiler = recorder.profiler_for(self.stage)
+        self.io = io_counters() if self.counters else None
+        self.resettable = self.counters and reset_peak_rss()
+        self.rss = rss() if self.counters else None
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        read = written = peak = rss_delta = None
+        if self.io is not None:
+            io = io_counters()
+            read, written = io[0] - self.io[0], io[1] - self.io[1]
+        if self.resettable:
+            peak = peak_rss()
+        if self.rss is not None:
+            rss_delta = rss() - self.rss
+        recorder.record(self.stage, self.name, wall, cpu, read, written, peak, rss_delta)
+
+def timed(stage, name):
+    """Time one file of a stage, if recording."""
+    if recorder is None:
+        return contextlib.nullcontext()
+    return Timer(stage, name, False)
+
+def stage(name):
+    """Time a stage of the main process, if recording. A stage entered several times adds up."""
+    if not isinstance(recorder, Metrics):
+        return contextlib.nullcontext()
+    return recorder.stage(name)
+
+def submit(ex, stage, name, func, *args):
+    """ex.submit(func, *args), timing the job on the worker as one file of stage if recording."""
+    if not isinstance(recorder, Metrics):
+        return ex.submit(func, *args)
+    return recorder.submit(ex, stage, name, func, *args)
+
+class Records:
+    """What a worker records while running one job, sent back with its result."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.profiler = None
+        self.records = []
+
+    def profiler_for(self, stage):
+        if stage != self.profile:
+            return None
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        return self.profiler
+
+    def record(self, *record):
+        self.records.append(record)
+
+    def stats(self):
+        if self.profiler is None:
+            return None
+        self.profiler.create_stats()
+        return self.profiler.stats
+
+def measure(stage, name, profile, func, *args):
+    """Run a job on a worker, returns its result, what was recorded and its profile if profiled."""
+    global recorder
+    recorder = Records(profile)
+    try:
+        with Timer(stage, name, True):
+            result = func(*args)
+        return result, recorder.records, recorder.stats()
+    finally:
+        recorder = None
+
+class ProfileStats:
+    # pstats.Stats loads anything with create_stats() and a stats dict
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class Metrics:
+    """Metrics of one run, recorded in the main process and merged with what workers send back."""
+
+    def __init__(self, slowest=10, profile=None):
+        self.slowest = slowest
+        self.profile = profile
+        self.profiler = None
+        self.profile_stats = None
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.sequence = 0
+        # Peaks of the stages entered right now, an inner stage resets the peak so it is added to these first
+        self.open = []
+        self.peak = None
+        self.resettable = reset_peak_rss()
+        self.start = time.perf_counter()
+
+    def get(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'entered': False, 'wall': 0.0, 'cpu': 0.0, 'read': 0, 'written': 0, 'peak': None, 'rss_delta': None,
+                'files': 0, 'file_wall': 0.0, 'file_cpu': 0.0, 'worker_cpu': 0.0, 'worker_read': 0, 'worker_written': 0, 'slowest': []}
+        return self.stages[name]
+
+    def profiler_for(self, stage):
+        # Only the thread that enables a profiler is profiled, which is always the main thread here
+        if stage != self.profile:
+            return None
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        return self.profiler
+
+    def fold_peak(self):
+        # Add the peak so far to every open stage, before it is reset or when a stage ends
+        peak = peak_rss()
+        if peak is not None:
+            self.peak = max(self.peak or 0, peak)
+            for stage_peak in self.open:
+                stage_peak[0] = max(stage_peak[0], peak)
+
+    def record(self, stage, name, wall, cpu, read=None, written=None, peak=None, rss_delta=None, worker=False):
+        with self.lock:
+            totals = self.get(stage)
+            totals['files'] += 1
+            totals['file_wall'] += wall
+            totals['file_cpu'] += cpu
+            if worker:
+                totals['worker_cpu'] += cpu
+                totals['worker_read'] += read or 0
+                totals['worker_written'] += written or 0
+            if peak is not None:
+                totals['peak'] = max(totals['peak'] or 0, peak)
+            if rss_delta is not None:
+                totals['rss_delta'] = (totals['rss_delta'] or 0) + rss_delta
+            # Keep the slowest files in a min heap, the sequence breaks ties
+            self.sequence += 1
+            entry = (wall, self.sequence, name, cpu)
+            if len(totals['slowest']) < self.slowest:
+                heapq.heappush(totals['slowest'], entry)
+            elif self.slowest > 0:
+                heapq.heappushpop(totals['slowest'], entry)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = self.profiler_for(name)
+        io = io_counters()
+        self.fold_peak()
+        if self.resettable:
+            reset_peak_rss()
+        stage_peak = [0]
+        self.open.append(stage_peak)
+        start_rss = rss()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            end_io = io_counters()
+            self.fold_peak()
+            self.open.remove(stage_peak)
+            peak = stage_peak[0] if self.resettable else None
+            end_rss = rss()
+            with self.lock:
+                totals = self.get(name)
+                totals['entered'] = True
+                totals['wall'] += wall
+                totals['cpu'] += cpu
+                if io is not None and end_io is not None:
+                    totals['read'] += end_io[0] - io[0]
+                    totals['written'] += end_io[1] - io[1]
+                if peak is not None:
+                    totals['peak'] = max(totals['peak'] or 0, peak)
+                if start_rss is not None and end_rss is not None:
+                    totals['rss_delta'] = (totals['rss_delta'] or 0) + end_rss - start_rss
+
+    def add_stats(self, stats):
+        if self.profile_stats is None:
+            self.profile_stats = pstats.Stats(ProfileStats(stats))
+        else:
+            self.profile_stats.add(ProfileStats(stats))
+
+    def submit(self, ex, stage, name, func, *args):
+        # The worker's future holds the result along with its records, pass on just the result
+        outer = Future()
+        def done(inner):
+            try:
+                result, records, stats = inner.result()
+            except BaseException as e:
+                outer.set_exception(e)
+                return
+            for record in records:
+                self.record(*record, worker=True)
+            if stats is not None:
+                with self.lock:
+                    self.add_stats(stats)
+            outer.set_result(result)
+        ex.submit(measure, stage, name, self.profile, func, *args).add_done_callback(done)
+        return outer
+
+    def report(self):
+        """The metrics as a JSON compatible dict."""
+        self.fold_peak()
+        stages = {}
+        for name in sorted(self.stages, key=STAGES.index):
+            totals = self.stages[name]
+            # Stages only timed per file, like the ones run on workers, are as long as their files took
+            entered = totals['entered']
+            have_io = entered or totals['worker_read'] or totals['worker_written']
+            stages[name] = {
+                'wall': totals['wall'] if entered else totals['file_wall'],
+                'cpu': totals['cpu'] + totals['worker_cpu'] if entered else totals['file_cpu'],
+                'read_bytes': totals['read'] + totals['worker_read'] if have_io else None,
+                'write_bytes': totals['written'] + totals['worker_written'] if have_io else None,
+                'peak_rss': totals['peak'],
+                'rss_delta': totals['rss_delta'],
+                'files': totals['files'],
+                'file_wall': totals['file_wall'],
+                'slowest': [{'file': name, 'wall': wall, 'cpu': cpu} for wall, _, name, cpu in sorted(totals['slowest'], reverse=True)]
+            }
+        return {
+            'command': sys.argv,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'wall': time.perf_counter() - self.start,
+            'peak_rss': self.peak,
+            'profile': None,
+            'stages': stages
+        }
+
+    def save(self, fname):
+        """Write the report, and the profile next to it if a stage was profiled. Returns the report."""
+        if self.profiler is not None:
+            self.profiler.create_stats()
+            self.add_stats(self.profiler.stats)
+            self.profiler = None
+        report = self.report()
+        if self.profile_stats is not None:
+            report['profile'] = profile_path(fname, self.profile)
+            self.profile_stats.dump_stats(report['profile'])
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(report, f, indent='\t')
+        os.replace(fname + '.tmp', fname)
+        return report
+
+def profile_path(fname, stage):
+    return os.path.splitext(fname)[0] + f'.{stage}.prof'
+
+def format_stage(name, stage):
+    line = f'{name}: {stage["wall"]:.2f}s wall, {stage["cpu"]:.2f}s CPU, {stage["files"]} files'
+    if stage['read_bytes'] is not None:
+        line += f', {stage["read_bytes"] / 1e6:.1f} MB read, {stage["write_bytes"] / 1e6:.1f} MB written'
+    if stage['peak_rss'] is not None:
+        line += f', peak RSS {stage["peak_rss"] / 1e6:.0f} MB'
+    if stage['rss_delta'] is not None:
+        line += f', RSS {stage["rss_delta"] / 1e6:+.0f} MB'
+    return line
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import numpy as np
+
+# Builds a full mip chain with 2x2 box filtering on NumPy arrays
+# Every level is reduced from the previous one with uint16 sums and stored in
+# a single preallocated buffer so the whole chain can be written at once
+
+STRIP_ROWS = 256
+
+def mip_sizes(width, height):
+    """Sizes of every level down to 1x1."""
+    sizes = [(width, height)]
+    while width > 1 or height > 1:
+        width, height = max(1, width // 2), max(1, height // 2)
+        sizes.append((width, height))
+    return sizes
+
+def sum_pairs(arr, axis):
+    # Sum pairs along an axis as uint16, an odd trailing row or column is added to the last pair
+    n = arr.shape[axis]
+    if n == 1:
+        return arr.astype(np.uint16), np.ones(1, dtype=np.uint16)
+    half = n // 2
+    index = [slice(None)] * arr.ndim
+    index[axis] = slice(0, half * 2, 2)
+    even = arr[tuple(index)]
+    index[axis] = slice(1, half * 2, 2)
+    out = np.add(even, arr[tuple(index)], dtype=np.uint16)
+    counts = np.full(half, 2, dtype=np.uint16)
+    if n % 2:
+        index[axis] = slice(half - 1, half)
+        tail = [slice(None)] * arr.ndim
+        tail[axis] = slice(n - 1, n)
+        out[tuple(index)] += arr[tuple(tail)]
+        counts[-1] = 3
+    return out, counts
+
+def reduce(level, out):
+    """2x2 box filter a uint8 level into out, a strip of rows at a time to bound temporary memory."""
+    height = level.shape[0]
+    out_height = out.shape[0]
+    for start in range(0, out_height, STRIP_ROWS):
+        end = min(start + STRIP_ROWS, out_height)
+        # The last strip also takes an odd trailing row
+        rows, row_counts = sum_pairs(level[start*2:end*2 if end < out_height else height], 0)
+        total, col_counts = sum_pairs(rows, 1)
+        if (row_counts == 2).all() and (col_counts == 2).all():
+            total += 2
+            total >>= 2
+        else:
+            divisor = np.multiply.outer(row_counts, col_counts)
+            if total.ndim == 3:
+                divisor = divisor[:, :, None]
+            total += divisor // 2
+            total //= divisor
+        np.copyto(out[start:end], total, casting='unsafe')
+
+def build_mip_chain(arr, encode=None, block_bytes=None):
+    """Return (buffer, mip count) holding every level of an HxW or HxWxC uint8 array.
+    With encode and block_bytes set, each level is block compressed into the buffer."""
+    height, width = arr.shape[:2]
+    sizes = mip_sizes(width, height)
+    extra = arr.shape[2:]
+    if encode is None:
+        level_bytes = [w * h * (extra[0] if extra else 1) for w, h in sizes]
+    else:
+        level_bytes = [((w + 3) // 4) * ((h + 3) // 4) * block_bytes for w, h in sizes]
+    buffer = np.empty(sum(level_bytes), dtype=np.uint8)
+
+    # Uncompressed levels are reduced straight into the buffer, compressed
+    # levels need a scratch array since the buffer holds blocks
+    offset = 0
+    previous = None
+    for (w, h), size in zip(sizes, level_bytes):
+        if previous is None:
+            level = arr
+            if encode is None:
+                buffer[offset:offset+size] = arr.reshape(-1)
+        else:
+            if encode is None:
+                level = buffer[offset:offset+size].reshape(h, w, *extra)
+            else:
+                level = np.empty((h, w, *extra), dtype=np.uint8)
+            reduce(previous, level)
+        if encode is not None:
+            buffer[offset:offset+size] = np.frombuffer(encode(level), dtype=np.uint8)
+        previous = level
+        offset += size
+    return buffer, len(sizes)
+
+def write_pil(fname, img):
+    # Previous approach, resizing the image with PIL for every level
+    from PIL import Image
+    width, height = img.size
+    mipmaps = int(np.log2(min(width, height)))+1
+    with open(fname, 'wb') as f:
+        for i in range(1, mipmaps+1):
+            f.write(img.tobytes('raw'))
+            if i != mipmaps:
+                img = img.resize((img.size[0] // 2, img.size[1] // 2), resample=Image.BILINEAR)
+
+def write_numpy(fname, img):
+    buffer, _ = build_mip_chain(np.asarray(img))
+    with open(fname, 'wb') as f:
+        f.write(buffer)
+
+def benchmark(name, size, mode, queue):
+    import tempfile
+    from PIL import Image
+    try:
+        import resource
+        rss = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        rss = lambda: 0
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (size, size, len(mode)), dtype=np.uint8).squeeze(), mode)
+    before = rss()
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        (write_pil if name == 'PIL' else write_numpy)(os.path.join(tmp, 'out.dds'), img)
+        elapsed = time.perf_counter() - start
+    queue.put((elapsed, rss() - before))
+
+if __name__ == '__main__':
+    # Compare against per level PIL resizing, each run in its own process to measure peak memory
+    import multiprocessing
+
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+    else:
+        sizes = [2048, 4096]
+    queue = multiprocessing.Queue()
+    for size in sizes:
+        for mode in ('L', 'RGBA'):
+            for name in ('PIL', 'NumPy'):
+                proc = multiprocessing.Process(target=benchmark, args=(name, size, mode, queue))
+                proc.start()
+                elapsed, peak = queue.get()
+                proc.join()
+                print(f'{name}: {size}x{size} {mode} {elapsed * 1000:.0f} ms, peak RSS +{peak:.0f} MB')
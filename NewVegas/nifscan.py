@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import struct
+
+# Reads BSShaderTextureSet blocks straight out of Fallout 3/New Vegas NIF files
+# Only the header is parsed, every other block is skipped using the block size table
+
+NIF_VERSION = 0x14020007 # 20.2.0.7
+NIF_USER_VERSION = 11 # Fallout 3/New Vegas
+MAX_TEXTURES = 32
+
+def read_struct(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of file')
+    return struct.unpack(fmt, data)
+
+def read_sized_string(f):
+    length, = read_struct(f, '<I')
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError('Unexpected end of file')
+    return data
+
+def read_texture_sets(fname):
+    """Return the texture paths of every BSShaderTextureSet block in file order,
+    or None if the file is not a Fallout 3/New Vegas NIF and needs a full parser."""
+    with open(fname, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+
+        # Header string, version, endianness and user version
+        line = f.readline(64)
+        if not line.startswith(b'Gamebryo File Format') or not line.endswith(b'\n'):
+            return None
+        version, endian, user_version, num_blocks = read_struct(f, '<IBII')
+        if version != NIF_VERSION or endian != 1 or user_version != NIF_USER_VERSION:
+            return None
+
+        # Bethesda stream header: version, then author, process script and export script
+        read_struct(f, '<I')
+        for _ in range(3):
+            length, = read_struct(f, '<B')
+            f.seek(length, 1)
+
+        # Block type table, block type of each block and size of each block
+        num_block_types, = read_struct(f, '<H')
+        block_types = [read_sized_string(f) for _ in range(num_block_types)]
+        type_indices = read_struct(f, f'<{num_blocks}H')
+        block_sizes = read_struct(f, f'<{num_blocks}I')
+
+        # String table and groups
+        num_strings, _ = read_struct(f, '<II')
+        for _ in range(num_strings):
+            length, = read_struct(f, '<I')
+            f.seek(length, 1)
+        num_groups, = read_struct(f, '<I')
+        f.seek(num_groups * 4, 1)
+
+        offset = f.tell()
+        if offset + sum(block_sizes) > file_size:
+            raise ValueError('Block sizes exceed file size')
+        if b'BSShaderTextureSet' not in block_types:
+            return []
+        texture_set = block_types.index(b'BSShaderTextureSet')
+
+        # Seek straight to each texture set
+        result = []
+        for type_index, block_size in zip(type_indices, block_sizes):
+            if type_index & 0x7FFF == texture_set:
+                f.seek(offset)
+                num_textures, = read_struct(f, '<i')
+                if num_textures < 0 or num_textures > MAX_TEXTURES:
+                    raise ValueError(f'Bad texture count {num_textures}')
+                result.append([read_sized_string(f) for _ in range(num_textures)])
+            offset += block_size
+        return result
+
+if __name__ == '__main__':
+    # Benchmark against the PyFFI path in usdagen.py
+    import usdagen
+    from concurrent.futures import ProcessPoolExecutor
+
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} meshes_folder')
+        sys.exit(1)
+
+    niflist = []
+    for root, _, files in os.walk(sys.argv[1]):
+        for file in files:
+            if file.lower().endswith('.nif'):
+                niflist.append(os.path.join(root, file))
+    niflist.sort()
+
+    results = {}
+    for name, func in (('nifscan', usdagen.process_nif), ('PyFFI', usdagen.process_nif_pyffi)):
+        if name == 'PyFFI' and not usdagen.have_PyFFI:
+            print('PyFFI not installed, skipping')
+            continue
+        start = time.perf_counter()
+        with ProcessPoolExecutor() as ex:
+            results[name] = list(ex.map(func, niflist, chunksize=16))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print(f'{name}: {len(niflist)} files in {elapsed:.2f}s, {len(niflist) / elapsed:.1f} files/s')
+
+    if len(results) == 2:
+        # Block order may differ from PyFFI's tree order, compare as sets
+        mismatched = [fname for fname, a, b in zip(niflist, results['nifscan'], results['PyFFI']) if sorted(map(repr, a)) != sorted(map(repr, b))]
+        print(f'{len(niflist) - len(mismatched)}/{len(niflist)} files matched')
+        for fname in mismatched[:10]:
+            print(f'Mismatch: {fname}')
@@ -2,12 +2,25 @@ import os
 import sys
 import math
 import argparse
-import xxhash
 import difflib
+import io
 import json
 import contextlib
 
-# PyFFI required to process NIF
+# Shared DDS hashing lives in the repository root
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ddshash
+import hashindex
+import hashmap
+import xxhash
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+# Fallout 3/New Vegas NIFs are read directly, PyFFI is used for anything else
+import nifscan
+import watcher
+import metrics
 
 # Version of PyFFI on pypi is old, work around time.clock() removal
 import time
@@ -15,12 +28,27 @@ time.clock = time.time
 
 try:
     from pyffi.formats.nif import NifFormat
-    from concurrent.futures import ProcessPoolExecutor, as_completed
     have_PyFFI = True
 except:
-    print('Warning: PyFFI not installed, NIF parsing disabled')
+    print('Warning: PyFFI not installed, only Fallout 3/New Vegas NIFs can be parsed')
     have_PyFFI = False
 
+# PIL required to process DDS, also needed by the generation workers
+try:
+    from PIL import Image, ImageChops
+    have_PIL = True
+except:
+    have_PIL = False
+
+# NumPy required to block compress generated textures, and builds mipmaps faster
+try:
+    import numpy
+    import bcn
+    import mipchain
+    have_numpy = True
+except:
+    have_numpy = False
+
 # Prevent import warnings for sub processes
 if __name__ == '__main__':
     try:
@@ -32,13 +60,8 @@ if __name__ == '__main__':
         pbprint = print
         have_tqdm = False
 
-    # PIL required to process DDS
-    try:
-        from PIL import Image, ImageChops
-        have_PIL = True
-    except:
+    if not have_PIL:
         print('Warning: Pillow not installed, normal map reflectivity disabled')
-        have_PIL = False
 
 
 # Map suffix to asset inputs
@@ -49,7 +72,7 @@ extensions = {
 '_g': 'emissive_mask_texture'
 }
 
-# The suffixes are not always consistent
+# The suffixes are not always consistent, keyed by relpathstd path
 overrides = {
 'textures/architecture/chandelier/chandelier.dds': {'_g': '_m'},
 'textures/architecture/freeside/atomicwranglersign.dds': {'_g': '_m'},
@@ -94,81 +117,425 @@ blacklist = [
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+# Persistent hash index, set up in main
+hash_index = None
+
 def calculate_hash(file_path):
-    if not os.path.exists(file_path):
+    # Only the header and first mipmap are read, and only if the file changed
+    with metrics.timed('hash', file_path):
+        if hash_index is not None:
+            hash_value = hash_index.hash_file(file_path)
+        elif not os.path.exists(file_path):
+            return None
+        else:
+            hash_value = ddshash.hash_file(file_path)
+    if hash_value is None:
         return None
-    with open(file_path, 'rb') as file:
-        data = file.read()
-
-    # Extract info from the DDS header
-    dwHeight = int.from_bytes(data[12:16], 'little')
-    dwWidth  = int.from_bytes(data[16:20], 'little')
-    pfFlags  = int.from_bytes(data[80:84], 'little')
-    pfFourCC = data[84:88]
-    bitCount = int.from_bytes(data[88:92], 'little')
-
-    # Calculate mipmap size
-    mipsize = dwWidth*dwHeight
-    if pfFlags & 0x4: # DDPF_FOURCC
-        if pfFourCC == b'DXT1': # DXT1 is 4bpp
-            mipsize //= 2
-    elif pfFlags & 0x20242: # DDPF_ALPHA | DDPF_RGB | DDPF_YUV | DDPF_LUMINANCE
-        mipsize = mipsize*bitCount//8
-
-    # Calculate hash of the first mipmap
-    return xxhash.xxh3_64(data[128:128+mipsize]).hexdigest().upper()
+    return ddshash.format_hash(hash_value)
 
 def u32(num):
     return num.to_bytes(4, 'little')
 
-def write_dds(file_name, img):
+def write_dds_header(f, width, height, channels, compress, mipmaps):
+    # Header
+    f.write(b'DDS ') # ID
+    f.write(u32(124)) # Header size
+    if compress:
+        f.write(b'\x07\x10\x0A\x00') # Flags (Caps, Height, Width, PixelFormat, MipMaps, LinearSize)
+    else:
+        f.write(b'\x0F\x10\x02\x00') # Flags (Caps, Height, Width, Pitch, PixelFormat, MipMaps)
+    f.write(u32(height)) # Height
+    f.write(u32(width)) # Width
+    if compress:
+        f.write(u32(((width+3)//4) * ((height+3)//4) * (8 if channels == 1 else 16))) # Linear size
+    else:
+        f.write(u32(width * channels)) # Pitch
+    f.write(u32(1)) # Depth
+    f.write(u32(mipmaps)) # MipMaps
+    f.write(b'\0' * 44) # Reserved
+    # Pixel format
+    f.write(u32(32)) # Format header size
+    f.write(b'\x04\x00\x00\x00') # Format flags (FourCC)
+    f.write(b'DX10') # FourCC
+    f.write(b'\0' * 20) # Bit count and R G B A masks
+    f.write(b'\x08\x10\x40\x00') # Caps (Complex, Texture, MipMaps)
+    f.write(b'\0' * 16) # Extra caps and reserved
+    # DX10 Header
+    if channels == 1:
+        f.write(u32(bcn.DXGI_FORMAT_BC4_UNORM if compress else 61)) # BC4_UNORM or R8_UNORM
+    elif channels == 4:
+        f.write(u32(bcn.DXGI_FORMAT_BC3_UNORM if compress else 28)) # BC3_UNORM or R8G8B8A8_UNORM
+    f.write(u32(3)) # Texture2D resource
+    f.write(u32(0)) # Misc flags
+    f.write(u32(1)) # Array size
+    f.write(u32(0)) # Misc flags 2
+
+def write_dds_array(file_name, arr, compress=False):
+    height, width = arr.shape[:2]
+    channels = arr.shape[2] if arr.ndim == 3 else 1
+    if channels != 1 and channels != 4:
+        raise NotImplementedError(f'Writing {channels} channel DDS unsupported')
+    # Build the whole mip chain in one buffer
+    if not compress:
+        data, mipmaps = mipchain.build_mip_chain(arr)
+    elif channels == 1:
+        data, mipmaps = mipchain.build_mip_chain(arr, bcn.encode_bc4, 8)
+    else:
+        data, mipmaps = mipchain.build_mip_chain(arr, bcn.encode_bc3, 16)
+    with open(file_name, 'wb') as f:
+        write_dds_header(f, width, height, channels, compress, mipmaps)
+        f.write(data)
+
+def write_dds(file_name, img, compress=False):
+    if have_numpy:
+        write_dds_array(file_name, numpy.asarray(img), compress)
+        return
     width, height = img.size
     channels = len(img.getbands())
-    mipmaps = int(math.log2(min(width, height)))+1
     if channels != 1 and channels != 4:
         raise NotImplementedError(f'Writing {channels} channel DDS unsupported')
+    mipmaps = int(math.log2(min(width, height)))+1
     with open(file_name, 'wb') as f:
-        # Header
-        f.write(b'DDS ') # ID
-        f.write(u32(124)) # Header size
-        f.write(b'\x0F\x10\x02\x00') # Flags (Caps, Height, Width, Pitch, PixelFormat, MipMaps)
-        f.write(u32(height)) # Height
-        f.write(u32(width)) # Width
-        f.write(u32(width * channels)) # Pitch
-        f.write(u32(1)) # Depth
-        f.write(u32(mipmaps)) # MipMaps
-        f.write(b'\0' * 44) # Reserved
-        # Pixel format
-        f.write(u32(32)) # Format header size
-        f.write(b'\x04\x00\x00\x00') # Format flags (Single channel uncompressed)
-        f.write(b'DX10') # FourCC
-        f.write(b'\0' * 20) # Bit count and R G B A masks
-        f.write(b'\x08\x10\x40\x00') # Caps (Complex, Texture, MipMaps)
-        f.write(b'\0' * 16) # Extra caps and reserved
-        # DX10 Header
-        if channels == 1:
-            f.write(u32(61)) # R8_UNORM
-        elif channels == 4:
-            f.write(u32(28)) # R8G8B8A8_UNORM
-        f.write(u32(3)) # Texture2D resource
-        f.write(u32(0)) # Misc flags
-        f.write(u32(1)) # Array size
-        f.write(u32(0)) # Misc flags 2
+        write_dds_header(f, width, height, channels, compress, mipmaps)
         # Write image data
         for i in range(1, mipmaps+1):
             f.write(img.tobytes('raw'))
             if i != mipmaps:
                 img = img.resize((img.size[0] // 2, img.size[1] // 2), resample=Image.BILINEAR)
 
+def write_roughness_from_blocks(fname_reflect, dds, header, compress, dedup):
+    # Only the alpha half of each DXT3/DXT5 block is used, the colors are never decoded
+    fourcc = header[84:88]
+    height = int.from_bytes(header[12:16], 'little')
+    width = int.from_bytes(header[16:20], 'little')
+    mipmaps = 1
+    if int.from_bytes(header[8:12], 'little') & 0x20000: # DDSD_MIPMAPCOUNT
+        mipmaps = max(1, int.from_bytes(header[28:32], 'little'))
+    sizes = mipchain.mip_sizes(width, height)
+    block_counts = [((w+3)//4) * ((h+3)//4) for w, h in sizes[:mipmaps]]
+
+    if fourcc == b'DXT5' and len(block_counts) == len(sizes):
+        # DXT5 alpha blocks are BC4 blocks, invert the source's own mip chain without decoding it
+        size = sum(block_counts) * 16
+        data = dds.read(size)
+        if len(data) == size:
+            def write(file_name):
+                blocks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 16)
+                with open(file_name, 'wb') as f:
+                    write_dds_header(f, width, height, 1, True, len(sizes))
+                    f.write(bcn.invert_bc4_blocks(blocks[:, :8]).tobytes())
+            return write_generated(fname_reflect, write, (f'invert {width}x{height}', data) if dedup else None)
+        # Truncated mip chain, rebuild it from the first level
+        dds.seek(128)
+
+    # Decode just the alpha of the first mipmap and build the chain from it
+    data = dds.read(block_counts[0] * 16)
+    if len(data) != block_counts[0] * 16:
+        raise ValueError(f'{dds.name}: Truncated DDS')
+    blocks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 16)
+    if fourcc == b'DXT5':
+        alpha = bcn.decode_bc4_blocks(blocks[:, :8])
+    else:
+        alpha = bcn.decode_bc2_alpha_blocks(blocks[:, :8])
+    return save_dds(fname_reflect, 255 - bcn.from_blocks(alpha, width, height), compress, dedup)
+
+# Bump when generated output changes, so existing files are regenerated
+GENERATOR_VERSION = 2
+
+def dedup_path(desc, pixels):
+    """Path of a generated texture named by the xxh3 hash of what it is built from."""
+    hasher = xxhash.xxh3_64(f'{desc} {GENERATOR_VERSION} {have_numpy}'.encode())
+    hasher.update(pixels)
+    return os.path.join('generated', 'dedup', ddshash.format_hash(hasher.intdigest()) + '.dds').replace('\\', '/')
+
+def write_generated(file_name, write, dedup_key=None):
+    """Write a generated texture with write(path) and return its path. With dedup_key set the texture
+    is stored by content instead, and nothing is written if an identical one already exists."""
+    if dedup_key is None:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with metrics.timed('dds_write', file_name):
+            write(file_name)
+        return file_name
+    file_name = dedup_path(*dedup_key)
+    if not os.path.exists(file_name):
+        # Workers can race on the same content, each writes its own file and swaps it in
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        tmp = f'{file_name}.{os.getpid()}.tmp'
+        with metrics.timed('dds_write', file_name):
+            write(tmp)
+        os.replace(tmp, file_name)
+    return file_name
+
+def save_dds(file_name, img, compress, dedup):
+    # Pixels are hashed before any mipmaps are built or encoded
+    if have_numpy:
+        img = numpy.ascontiguousarray(img)
+    dedup_key = None
+    if dedup:
+        if have_numpy:
+            dedup_key = (f'{img.shape} {compress}', img)
+        else:
+            dedup_key = (f'{img.size} {img.mode} {compress}', img.tobytes())
+    return write_generated(file_name, lambda path: write_dds(path, img, compress), dedup_key)
+
+def roughness_path(normal_path):
+    normal_noext = os.path.splitext(normal_path)[0].removesuffix('_n')
+    return os.path.join('generated', normal_noext + '_r.dds').replace('\\', '/')
+
+def emission_path(glow_path):
+    return os.path.join('generated', glow_path).replace('\\', '/')
+
+def generate_roughness(fname_reflect, normal_file, normal_path, compress, dedup):
+    with open(normal_file, 'rb') as dds:
+        header = dds.read(128)
+        # DXT1 has 1 bit alpha, which is unsuitable for a specular map, ignore
+        if header[84:88] == b'DXT1':
+            return None, None
+        # Only the alpha blocks are needed, skip decoding the whole image. Uncompressed
+        # output from DXT5 is left to PIL, whose decoder is faster than NumPy's there
+        if have_numpy and (header[84:88] == b'DXT3' or (compress and header[84:88] == b'DXT5')):
+            return write_roughness_from_blocks(fname_reflect, dds, header, compress, dedup), None
+    with Image.open(normal_file) as img:
+        if 'A' not in img.mode:
+            return None, f'Warning: {normal_path}: expected alpha in mode, found {img.mode}'
+        return save_dds(fname_reflect, ImageChops.invert(img.getchannel('A')), compress, dedup), None
+
+def generate_emission(fname_glow, diffuse_file, glow_file, compress, dedup):
+    with Image.open(diffuse_file) as img_d:
+        with Image.open(glow_file) as img_g:
+            if 'A' not in img_d.mode:
+                img_d.putalpha(255)
+            if 'A' not in img_g.mode:
+                img_g.putalpha(255)
+            if img_d.size != img_g.size:
+                img_d = img_d.resize(img_g.size, resample=Image.BILINEAR)
+            return save_dds(fname_glow, ImageChops.multiply(img_d, img_g), compress, dedup), None
+
+class TextureGenerator:
+    """Runs generation jobs, skipping outputs whose sources and parameters are unchanged since the last run."""
+
+    def __init__(self, ex, manifest_path, dedup=False):
+        self.ex = ex
+        self.manifest_path = manifest_path
+        # Deduplicated jobs write to a file named by their pixels, never to the output itself
+        self.dedup = dedup
+        # Every job submitted for each output, in order, as (job, future, key, skipped)
+        self.outputs = {}
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def entries(self, output):
+        # Manifest entries of every job the output had last run, older manifests kept only one
+        entries = self.manifest.get(output, [])
+        return [entries] if isinstance(entries, dict) else entries
+
+    def submit(self, func, output, source_hashes, *args):
+        # Identical jobs share one result, without dedup a different job for the same output
+        # waits for the previous one so the last writer wins just like a serial run
+        job = (func, args)
+        jobs = self.outputs.setdefault(output, [])
+        if jobs:
+            previous, future, _, _ = jobs[-1]
+            if previous == job:
+                return future
+            if not self.dedup:
+                future.result()
+
+        key = {
+            'job': [func.__name__, *args],
+            'version': GENERATOR_VERSION,
+            'numpy': have_numpy,
+            'sources': source_hashes
+        }
+        # A job is up to date if it and every job before it for the same output are unchanged,
+        # deduplicated jobs don't overwrite each other so only their own key matters
+        entries = self.entries(output)
+        index = len(jobs)
+        skipped = (index < len(entries) and entries[index]['key'] == key and (self.dedup or all(job[3] for job in jobs)) and
+            (entries[index]['result'][0] is None or os.path.exists(entries[index]['result'][0])))
+        if skipped:
+            future = Future()
+            future.set_result(tuple(entries[index]['result']))
+        elif self.ex is not None:
+            future = metrics.submit(self.ex, 'generate', output, func, output, *args)
+        else:
+            future = Future()
+            with metrics.timed('generate', output):
+                future.set_result(func(output, *args))
+        jobs.append((job, future, key, skipped))
+        return future
+
+    def rerun_shortened(self):
+        """Rerun the last job of outputs that had fewer jobs than last run, all of them up to date."""
+        # The output still holds what a later job wrote last run
+        if self.dedup:
+            return
+        for output, jobs in self.outputs.items():
+            if len(jobs) < len(self.entries(output)) and all(job[3] for job in jobs):
+                (func, args), _, key, _ = jobs[-1]
+                future = Future()
+                with metrics.timed('generate', output):
+                    future.set_result(func(output, *args))
+                jobs[-1] = ((func, args), future, key, False)
+
+    def finish(self):
+        """Update the manifest and delete previously generated files that nothing uses anymore, returns how many were deleted."""
+        # Every job's result is used by a material, and deduplicated files can be shared
+        # by several outputs, only delete them once none are left
+        live = {future.result()[0] for jobs in self.outputs.values() for _, future, _, _ in jobs}
+        previous = {entry['result'][0] for output in self.manifest for entry in self.entries(output)}
+        deleted = 0
+        for result in previous - live:
+            if result is not None and os.path.exists(result):
+                os.remove(result)
+                deleted += 1
+        self.manifest = {}
+        for output, jobs in self.outputs.items():
+            self.manifest[output] = [{'key': key, 'result': list(future.result())} for _, future, key, _ in jobs]
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent='\t')
+        return deleted
+
+USDA_HEADER = '#usda 1.0\nover "RootNode"\n{\n\tover "Looks"\n\t{\n'
+USDA_FOOTER = '\t}\n}\n'
+
+def write_atomic(fname, data):
+    # Write under a temporary name in one go, then swap it in so readers never see a partial file
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, fname)
+
+class ShardedLayer:
+    """Collects materials into one sublayer per texture folder, listed by a root layer.
+    Shards are built in memory and only rewritten if their content hash changed."""
+
+    def __init__(self, output):
+        self.output = output
+        self.shard_dir = os.path.splitext(output)[0]
+        self.manifest_path = os.path.join(self.shard_dir, 'shards.json')
+        self.shards = {}
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def shard(self, diffuse_path):
+        """The buffer for the material of a diffuse texture, and what to prefix its asset paths with."""
+        # Materials are grouped by the folder of their diffuse texture
+        name = os.path.dirname(diffuse_path)
+        if name not in self.shards:
+            self.shards[name] = io.StringIO()
+            self.shards[name].write(USDA_HEADER)
+        # Relative asset paths resolve against the shard, not the root layer they were written for
+        root = os.path.dirname(os.path.abspath(self.output))
+        anchor = os.path.relpath(root, os.path.dirname(os.path.abspath(self.shard_path(name)))).replace('\\', '/') + '/'
+        return self.shards[name], anchor
+
+    def shard_path(self, name):
+        return os.path.join(self.shard_dir, name + '.usda')
+
+    def finish(self):
+        """Write changed shards and the root layer, returns (written, unchanged, deleted) shard counts."""
+        written = 0
+        unchanged = 0
+        deleted = 0
+        manifest = {}
+        for name, buffer in self.shards.items():
+            buffer.write(USDA_FOOTER)
+            data = buffer.getvalue()
+            manifest[name] = xxhash.xxh3_64_hexdigest(data.encode('utf-8'))
+            fname = self.shard_path(name)
+            if self.manifest.get(name) == manifest[name] and os.path.exists(fname):
+                unchanged += 1
+                continue
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            write_atomic(fname, data)
+            written += 1
+
+        # Remove shards for folders that no longer have materials
+        for name in self.manifest:
+            if name not in manifest and os.path.exists(self.shard_path(name)):
+                os.remove(self.shard_path(name))
+                deleted += 1
+
+        # Root layer only lists the shards, it changes when folders come and go
+        root = os.path.dirname(os.path.abspath(self.output))
+        sublayers = [os.path.relpath(self.shard_path(name), root).replace('\\', '/') for name in self.shards]
+        data = '#usda 1.0\n(\n\tsubLayers = [\n' + ',\n'.join(f'\t\t@./{path}@' for path in sublayers) + '\n\t]\n)\n'
+        current = None
+        if os.path.exists(self.output):
+            with open(self.output) as f:
+                current = f.read()
+        if current != data:
+            write_atomic(self.output, data)
+
+        os.makedirs(self.shard_dir, exist_ok=True)
+        write_atomic(self.manifest_path, json.dumps(manifest, indent='\t'))
+        self.manifest = manifest
+        return written, unchanged, deleted
+
+def write_material(f, anchor, diffuse_hash, diffuse_path, inputs):
+    f.write('\t\tover "mat_' + diffuse_hash + '"\n\t\t{\n\t\t\tover "Shader"\n\t\t\t{\n')
+    if '_n' in inputs:
+        # Force DX normals
+        f.write('\t\t\t\tint inputs:encoding = 2 \n')
+    if '_g' in inputs:
+        # Set up emission
+        f.write('\t\t\t\tbool inputs:enable_emission = 1 \n')
+        f.write('\t\t\t\tfloat inputs:emissive_intensity = 10 \n')
+    # Write texture inputs
+    f.write('\t\t\t\tasset inputs:diffuse_texture = @' + anchor + diffuse_path + '@ \n')
+    for ext in inputs:
+        if ext == 'reflect':
+            f.write(f'\t\t\t\tasset inputs:reflectionroughness_texture = @' + anchor + inputs[ext] + '@ \n')
+        elif ext in extensions:
+            f.write(f'\t\t\t\tasset inputs:{extensions[ext]} = @' + anchor + inputs[ext] + '@ \n')
+    f.write('\t\t\t}\n\t\t}\n')
+
+def finish_material(f, anchor, diffuse_hash, diffuse_path, inputs, roughness, emission):
+    # Wait for this material's generated textures, then write it to the USDA
+    generated = 0
+    if roughness is not None:
+        fname_reflect, warning = roughness.result()
+        if fname_reflect is not None:
+            inputs['reflect'] = fname_reflect
+            generated += 1
+        elif warning is not None:
+            pbprint(warning)
+    if emission is not None:
+        inputs['_g'], _ = emission.result()
+        generated += 1
+    write_material(f, anchor, diffuse_hash, diffuse_path, inputs)
+    return generated
+
 def clean_path(path):
     path = os.path.normpath(path.decode('utf-8')).lower().replace('\\', '/')
     if path.startswith('data/'):
         path = path[5:]
     return path
 
-def process_nif(fname):
+def process_texture_sets(texture_sets):
     input_names = ['_d', '_n', '_g', '_p', '_e', '_m']
     result = []
+    for textures in texture_sets:
+        # Sets without a diffuse texture have nothing to attach inputs to
+        if not textures or textures[0] == b'':
+            continue
+        inputs = {}
+        for i in range(1, min(6, len(textures))):
+            if textures[i] != b'':
+                texture = clean_path(textures[i])
+                if texture not in blacklist:
+                    inputs[input_names[i]] = texture
+        result.append((clean_path(textures[0]), inputs))
+    return result
+
+def process_nif_pyffi(fname):
+    texture_sets = []
     try:
         with open(fname, 'rb') as f:
             data = NifFormat.Data()
@@ -176,28 +543,296 @@ def process_nif(fname):
             for nifroot in data.roots:
                 for block in nifroot.tree():
                     if isinstance(block, NifFormat.BSShaderTextureSet):
-                        inputs = {}
-                        for i in range(1, 6):
-                            if block.textures[i] != b'':
-                                texture = clean_path(block.textures[i])
-                                if texture not in blacklist:
-                                    inputs[input_names[i]] = texture
-                        result.append((clean_path(block.textures[0]), inputs))
-    except:
-        pass
-    return result
+                        texture_sets.append(list(block.textures))
+        return process_texture_sets(texture_sets)
+    except Exception as e:
+        eprint(f'Warning: {fname}: {e!r}')
+        return []
+
+def process_nif(fname):
+    # Read texture sets directly for Fallout 3/New Vegas NIFs, fall back to PyFFI for anything else
+    try:
+        texture_sets = nifscan.read_texture_sets(fname)
+    except (OSError, ValueError) as e:
+        eprint(f'Warning: {fname}: {e}')
+        texture_sets = None
+    if texture_sets is None:
+        return process_nif_pyffi(fname) if have_PyFFI else []
+    try:
+        return process_texture_sets(texture_sets)
+    except UnicodeDecodeError as e:
+        eprint(f'Warning: {fname}: {e}')
+        return []
+
+def nif_cache_stale(entry, st):
+    return entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns
+
+def merge_texture_set(nifmap, diffuse, inputs):
+    if diffuse in nifmap:
+        current = nifmap[diffuse]
+        if any(k not in current or current[k] != inputs[k] for k in inputs):
+            # Merge the sets together
+            pbprint(f'Warning: {diffuse} has multiple texture sets')
+            for input in inputs:
+                if input not in current:
+                    current[input] = inputs[input]
+                else:
+                    # Use whatever texture is closest to the diffuse
+                    current[input] = difflib.get_close_matches(diffuse, [current[input], inputs[input]], n=1, cutoff=0)[0]
+    else:
+        nifmap[diffuse] = dict(inputs)
 
 def relpathstd(path, start=''):
     return os.path.relpath(path, start).lower().replace('\\', '/')
 
+def scan_textures(txrdir, rootdir):
+    """Walk the textures folder once with os.scandir, in the same order as os.walk.
+    Returns the .dds files and a dict of them keyed by relpathstd(fname, rootdir)."""
+    ddslist = []
+    ddsfiles = {}
+    def scan(path, relpath):
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # Like os.walk, symlinked folders are not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry)
+                elif entry.name.lower().endswith('.dds'):
+                    ddslist.append(entry.path)
+                    key = relpath + entry.name.lower()
+                    # Paths only differing in case are the same texture to the game, keep the first
+                    if key in ddsfiles:
+                        print(f'Warning: {entry.path}: same path as {ddsfiles[key]} ignoring case, skipping')
+                    else:
+                        ddsfiles[key] = entry.path
+        for entry in subdirs:
+            scan(entry.path, relpath + entry.name.lower() + '/')
+    scan(txrdir, relpathstd(txrdir, rootdir) + '/')
+    return ddslist, ddsfiles
+
+def update_nifcache(meshes, nifcache, ex=None):
+    """Reparse .nif files added or changed since they were cached, returns how many were parsed and removed."""
+    # Gather a list of all .nif files
+    niflist = {}
+    for root, _, files in os.walk(meshes):
+        for file in files:
+            fname = os.path.join(root, file)
+            if fname.lower().endswith('.nif'):
+                niflist[relpathstd(fname, meshes)] = (fname, os.stat(fname))
+
+    # Only parse .nif files that were added or changed
+    changed = [nif for nif, (_, st) in niflist.items() if nif_cache_stale(nifcache.get(nif), st)]
+    removed = [nif for nif in nifcache if nif not in niflist]
+    for nif in removed:
+        del nifcache[nif]
+
+    # Process all .nif using multiple cores
+    if changed:
+        print(f'Processing {len(changed)} .nif files')
+        with tqdm(total=len(changed)) if have_tqdm else contextlib.nullcontext() as pbar:
+            with ProcessPoolExecutor() if ex is None else contextlib.nullcontext(ex) as pool:
+                futures = {metrics.submit(pool, 'nif', nif, process_nif, niflist[nif][0]): nif for nif in changed}
+                for future in as_completed(futures):
+                    nif = futures[future]
+                    st = niflist[nif][1]
+                    if pbar is not None:
+                        pbar.update(1)
+                    try:
+                        texture_sets = [[diffuse, inputs] for diffuse, inputs in future.result()]
+                    except Exception as e:
+                        # Not cached, so the file is parsed again next time
+                        pbprint(f'Warning: {niflist[nif][0]}: {e!r}')
+                        continue
+                    nifcache[nif] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sets': texture_sets}
+    return len(changed), len(removed)
+
+def build_nifmap(nifcache):
+    # Merge the per-file results, in a stable order
+    nifmap = {}
+    for nif in sorted(nifcache):
+        for diffuse, inputs in nifcache[nif]['sets']:
+            merge_texture_set(nifmap, diffuse, inputs)
+    return nifmap
+
+def write_usda(args, txrdir, rootdir, nifmap, hashmaps, compress, ex=None):
+    """Write the USDA for the textures folder, generating textures on ex if given."""
+    materials = 0
+    textures = 0
+    generated = 0
+    generated_bytes = 0
+    dedup_files = 0
+    dedup_bytes = 0
+    regenerated = 0
+    skipped = 0
+    deleted = 0
+    if hash_index is not None:
+        hash_index.hits = 0
+        hash_index.misses = 0
+    print(f'Writing {args.output}')
+    # Sharded output is collected in memory and written at the end, otherwise the
+    # USDA is swapped in once complete so Remix never loads a partial file
+    layer = ShardedLayer(args.output) if args.shard else None
+    with open(args.output + '.tmp', 'w') if layer is None else contextlib.nullcontext() as f:
+        # Write USDA header
+        if f is not None:
+            f.write(USDA_HEADER)
+
+        # Gather a list of all .dds files, indexed by path for sibling lookups
+        with metrics.stage('walk'):
+            ddslist, ddsfiles = scan_textures(txrdir, rootdir)
+
+        # Search through the textures folder
+        if ddslist:
+            used_hashes = {}
+            # Textures are generated on a process pool while the USDA is written in order
+            pending = deque()
+            generator = TextureGenerator(ex, os.path.join('generated', 'manifest.json'), args.dedup)
+            # Each file is hashed once per run, even if it's an input to several materials or generated from
+            file_hashes = {}
+            def file_hash(path):
+                if path not in file_hashes:
+                    file_hashes[path] = calculate_hash(path)
+                return file_hashes[path]
+            with metrics.stage('materials'):
+                for diffuse_path, fname in (tqdm if have_tqdm else lambda x: x)(ddsfiles.items()):
+                    diffuse_noext = os.path.splitext(diffuse_path)[0].removesuffix('_d') # Some diffuse end in _d
+
+                    # Look for extra inputs
+                    if diffuse_path in nifmap:
+                        inputs = dict(nifmap[diffuse_path])
+                    else:
+                        inputs = {}
+                        for ext in extensions:
+                            file_ext = ext
+                            if diffuse_path in overrides and ext in overrides[diffuse_path]:
+                                file_ext = overrides[diffuse_path][ext]
+                            input_path = diffuse_noext + file_ext + '.dds'
+                            if input_path in ddsfiles and input_path not in blacklist:
+                                inputs[ext] = input_path
+                    textures += len(inputs)
+
+                    if inputs:
+                        # Calculate hashes of textures
+                        hash_value = hashmaps.get(diffuse_path)
+                        if hash_value is not None:
+                            diffuse_hash = ddshash.format_hash(hash_value)
+                        else:
+                            diffuse_hash = file_hash(fname)
+                            if diffuse_hash is None:
+                                pbprint(f'Warning: {diffuse_path}: Not a valid DDS, skipping')
+                                continue
+                        hashes = {}
+                        paths = {}
+                        for ext in inputs:
+                            paths[ext] = ddsfiles.get(inputs[ext], os.path.join(rootdir, inputs[ext]))
+                            hash_value = hashmaps.get(inputs[ext])
+                            if hash_value is not None:
+                                hashes[ext] = ddshash.format_hash(hash_value)
+                            elif inputs[ext] in ddsfiles:
+                                hashes[ext] = file_hash(paths[ext])
+                            else:
+                                hashes[ext] = None
+
+                        # Check for duplicates
+                        input_set = tuple(inputs.values())
+                        # Missing or unreadable inputs have no hash to compare
+                        hash_set = tuple(hash_value for hash_value in hashes.values() if hash_value is not None)
+                        if diffuse_hash in used_hashes:
+                            # Check if duplicate is different
+                            if used_hashes[diffuse_hash][1] != hash_set:
+                                pbprint(f'Warning: Conflicting hash {diffuse_hash}: {used_hashes[diffuse_hash]} != {input_set, hash_set}')
+                        else:
+                            # No duplicate, write to usda
+                            materials += 1
+                            used_hashes[diffuse_hash] = (input_set, hash_set)
+
+                            # Split alpha off of normal map and invert as roughness map
+                            roughness = None
+                            if not args.no_generate and have_PIL and '_n' in inputs and inputs['_n'] in ddsfiles:
+                                roughness = generator.submit(generate_roughness, roughness_path(inputs['_n']), [file_hash(paths['_n'])], paths['_n'], inputs['_n'], compress, args.dedup)
+
+                            # Convert masked emission to additive emission
+                            emission = None
+                            if not args.no_generate and have_PIL and '_g' in inputs and inputs['_g'] in ddsfiles:
+                                emission = generator.submit(generate_emission, emission_path(inputs['_g']), [file_hash(fname), file_hash(paths['_g'])], fname, paths['_g'], compress, args.dedup)
+
+                            # Bound how far generation can run ahead of the writer
+                            # A single file keeps asset paths as they are, relative to where it is written
+                            out, anchor = (f, '') if layer is None else layer.shard(diffuse_path)
+                            pending.append((out, anchor, diffuse_hash, diffuse_path, inputs, roughness, emission))
+                            while len(pending) > args.jobs * 4:
+                                generated += finish_material(*pending.popleft())
+
+                while pending:
+                    generated += finish_material(*pending.popleft())
+
+            with metrics.stage('finish'):
+                generator.rerun_shortened()
+                # Each generated file counted once, even if shared by several materials or deduplicated
+                results = set()
+                for jobs in generator.outputs.values():
+                    for _, future, _, up_to_date in jobs:
+                        result = future.result()[0]
+                        if result is not None:
+                            if result in results:
+                                dedup_files += 1
+                                dedup_bytes += os.path.getsize(result)
+                            else:
+                                results.add(result)
+                                generated_bytes += os.path.getsize(result)
+                            if up_to_date:
+                                skipped += 1
+                            else:
+                                regenerated += 1
+
+                # Without generation nothing was checked, keep the existing outputs
+                if not args.no_generate and have_PIL:
+                    deleted = generator.finish()
+        else:
+            print('Warning: No textures found')
+        # Write USDA footer
+        if f is not None:
+            f.write(USDA_FOOTER)
+    with metrics.stage('finish'):
+        if layer is None:
+            os.replace(args.output + '.tmp', args.output)
+        else:
+            written, unchanged, removed = layer.finish()
+            print(f'Wrote {written} of {len(layer.shards)} shards to {layer.shard_dir}, {unchanged} unchanged, removed {removed}')
+        if hash_index is not None:
+            # Forget textures that were deleted since the last run
+            hash_index.prune(txrdir, ddslist)
+            hash_index.save()
+            print(f'Reused {hash_index.hits} hashes from {args.hash_index}, hashed {hash_index.misses} textures')
+
+    print(f'Wrote {materials} materials')
+    print(f'Wrote {generated} textures ({generated_bytes / 1e6:.1f} MB)')
+    print(f'Regenerated {regenerated} textures, {skipped} up to date, deleted {deleted}')
+    if args.dedup:
+        print(f'Deduplicated {dedup_files} textures, saved {dedup_bytes / 1e6:.1f} MB')
+    print(f'Used {textures} textures')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Generates a USDA to load the game's various textures.")
     parser.add_argument('-t', '--textures', help='The textures folder to search through', required=True)
     parser.add_argument('-m', '--meshes', help='The meshes folder to search through')
     parser.add_argument('-hm', '--hashes', help='Texture hash mapping list')
     parser.add_argument('-o', '--output', help='The USDA file to write', required=True)
+    parser.add_argument('-sh', '--shard', help='Write one sublayer per texture folder, with the output listing them in subLayers', action='store_true')
     parser.add_argument('-nc', '--no-use-cache', help="Don't use nifmap.json if present", action='store_true')
     parser.add_argument('-ng', '--no-generate', help="Don't generate additional textures", action='store_true')
+    parser.add_argument('-bc', '--block-compress', help='Write generated textures as BC4 (roughness) and BC3 (emission)', action='store_true')
+    parser.add_argument('-dd', '--dedup', help='Store generated textures by the hash of their pixels, so identical ones share a file', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of processes to generate textures with', type=int, default=os.cpu_count())
+    parser.add_argument('-hi', '--hash-index', help='Hash index to reuse hashes of unchanged textures from', default='hashindex.db')
+    parser.add_argument('-ni', '--no-index', help="Don't read or update the hash index", action='store_true')
+    parser.add_argument('-w', '--watch', help='Keep running, and update the USDA and generated textures whenever textures or meshes change', action='store_true')
+    parser.add_argument('--debounce', help='Seconds without changes to wait for before updating in watch mode', type=float, default=0.5)
+    parser.add_argument('--poll-interval', help='Seconds between scans in watch mode when watchdog is not installed', type=float, default=1.0)
+    parser.add_argument('--metrics-out', help='Write wall and CPU time, bytes read and written, peak and growth of memory and the slowest files of each stage to this JSON file')
+    parser.add_argument('--profile', help='Also profile a stage with cProfile, saved next to the metrics', choices=metrics.STAGES)
+    parser.add_argument('--slowest', help='Number of slowest files to report for each stage', type=int, default=10)
     args = parser.parse_args()
 
     # Validate inputs
@@ -209,8 +844,6 @@ if __name__ == '__main__':
         if not os.path.isdir(args.meshes):
             eprint(f'Error: {args.meshes}: No such directory')
             sys.exit(1)
-        if not have_PyFFI:
-            print('Warning: meshes folder given but PyFFI not installed')
 
     hashfiles = []
     if args.hashes is not None:
@@ -230,186 +863,101 @@ if __name__ == '__main__':
         eprint(f'Error: Failed to locate a folder named "textures"')
         sys.exit(1)
 
-    # Nif parsing is slow, use a cache if present
+    # Nif parsing is slow, reuse per-file results from nifmap.json for unchanged files
+    nifcache = {}
+    legacy_nifmap = None
     if os.path.exists('nifmap.json') and not args.no_use_cache:
         with open('nifmap.json') as f:
-            nifmap = json.load(f)
+            cache = json.load(f)
+        if isinstance(cache.get('nifs'), dict):
+            nifcache = cache['nifs']
+        else:
+            # Old cache without per-file results
+            legacy_nifmap = cache
         print('Loaded nif texture mapping from nifmap.json')
-    else:
-        nifmap = {}
-        if have_PyFFI and args.meshes is not None:
-            # Gather a list of all .nif files
-            niflist = []
-            for root, _, files in os.walk(args.meshes):
-                for file in files:
-                    fname = os.path.join(root, file)
-                    if fname.lower().endswith('.nif'):
-                        niflist.append(fname)
-
-            # Process all .nif using multiple cores
-            print('Processing .nif files')
-            with tqdm(total=len(niflist)) if have_tqdm else contextlib.nullcontext() as pbar:
-                with ProcessPoolExecutor() as ex:
-                    for future in as_completed([ex.submit(process_nif, fname) for fname in niflist]):
-                        try:
-                            for diffuse, inputs in future.result():
-                                if diffuse in nifmap:
-                                    current = nifmap[diffuse]
-                                    if any(k not in current or current[k] != inputs[k] for k in inputs):
-                                        # Merge the sets together
-                                        pbprint(f'Warning: {diffuse} has multiple texture sets')
-                                        for input in inputs:
-                                            if input not in current:
-                                                current[input] = inputs[input]
-                                            else:
-                                                # Use whatever texture is closest to the diffuse
-                                                current[input] = difflib.get_close_matches(diffuse, [current[input], inputs[input]], n=1, cutoff=0)[0]
-                                else:
-                                    nifmap[diffuse] = inputs
-                        except:
-                            pass
-                        if pbar is not None:
-                            pbar.update(1)
-
-            # Write map as json cache
-            print('Saving nif texture mapping to nifmap.json')
-            with open('nifmap.json', 'w') as f:
-                json.dump(nifmap, f, indent='\t')
-
-    # Load texture hash map if given
-    hashmap = {}
+
+    # Load texture hash maps if given, binary maps are memory mapped instead of read
+    hashmaps = []
     for hashfile in hashfiles:
         print(f'Loading hash map {hashfile}')
-        with open(hashfile) as f:
-            for line in f:
-                parts = line.split(' ', 1)
-                if len(parts) != 2 or len(parts[0]) != 18 or not parts[0].lower().startswith('0x'):
-                    eprint(f'Error: Malform texture hash line: {line}')
-                    sys.exit(1)
-                hashmap[relpathstd(parts[1].rstrip())] = parts[0][2:].upper()
-
-    # Write USDA
-    materials = 0
-    textures = 0
-    generated = 0
-    print(f'Writing {args.output}')
-    with open(args.output, 'w') as f:
-        # Write USDA header
-        f.write('#usda 1.0\nover "RootNode"\n{\n\tover "Looks"\n\t{\n')
-
-        # Gather a list of all .dds files
-        ddslist = []
-        for root, _, files in os.walk(txrdir):
-            for file in files:
-                fname = os.path.join(root, file)
-                if fname.lower().endswith('.dds'):
-                    ddslist.append(fname)
-
-        # Search through the textures folder
-        if ddslist:
-            used_hashes = {}
-            for fname in (tqdm if have_tqdm else lambda x: x)(ddslist):
-                diffuse_path = relpathstd(fname, rootdir)
-                fname_noext = os.path.splitext(fname)[0].removesuffix('_d') # Some diffuse end in _d
-
-                # Look for extra inputs
-                if diffuse_path in nifmap:
-                    inputs = nifmap[diffuse_path]
-                else:
-                    inputs = {}
-                    for ext in extensions:
-                        file_ext = ext
-                        if fname in overrides and ext in overrides[fname]:
-                            file_ext = overrides[fname][ext]
-                        extra_file = fname_noext + file_ext + '.dds'
-                        if os.path.exists(extra_file):
-                            input_path = relpathstd(extra_file, rootdir)
-                            if input_path not in blacklist:
-                                inputs[ext] = input_path
-                textures += len(inputs)
-
-                if inputs:
-                    # Calculate hashes of textures
-                    if diffuse_path in hashmap:
-                        diffuse_hash = hashmap[diffuse_path]
-                    else:
-                        diffuse_hash = calculate_hash(fname)
-                    hashes = {}
-                    paths = {}
-                    for ext in inputs:
-                        paths[ext] = os.path.join(rootdir, inputs[ext])
-                        if inputs[ext] in hashmap:
-                            hashes[ext] = hashmap[inputs[ext]]
-                        else:
-                            hashes[ext] = calculate_hash(paths[ext])
-
-                    # Check for duplicates
-                    input_set = tuple(inputs.values())
-                    hash_set = tuple(hashes.values())
-                    if diffuse_hash in used_hashes:
-                        # Check if duplicate is different
-                        if used_hashes[diffuse_hash][1] != hash_set:
-                            pbprint(f'Warning: Conflicting hash {diffuse_hash}: {used_hashes[diffuse_hash]} != {input_set, hash_set}')
-                    else:
-                        # No duplicate, write to usda
-                        materials += 1
-                        used_hashes[diffuse_hash] = (input_set, hash_set)
-
-                        # Split alpha off of normal map and invert as roughness map
-                        if not args.no_generate and have_PIL and '_n' in inputs and os.path.exists(paths['_n']):
-                            # DXT1 has 1 bit alpha, which is unsuitable for a specular map, ignore
-                            with open(paths['_n'], 'rb') as dds:
-                                dds.seek(84)
-                                not_dxt1 = dds.read(4) != b'DXT1'
-                            if not_dxt1:
-                                with Image.open(paths['_n']) as img:
-                                    if 'A' in img.mode:
-                                        normal_noext = os.path.splitext(inputs['_n'])[0].removesuffix('_n')
-                                        fname_reflect = os.path.join('generated', normal_noext + '_r.dds').replace('\\', '/')
-                                        inputs['reflect'] = fname_reflect
-                                        os.makedirs(os.path.dirname(fname_reflect), exist_ok=True)
-                                        write_dds(fname_reflect, ImageChops.invert(img.getchannel('A')))
-                                        generated += 1
-                                    else:
-                                        pbprint(f'Warning: {inputs["_n"]}: expected alpha in mode, found {img.mode}')
-
-                        # Convert masked emission to additive emission
-                        if not args.no_generate and have_PIL and '_g' in inputs and os.path.exists(paths['_g']):
-                            with Image.open(fname) as img_d:
-                                with Image.open(paths['_g']) as img_g:
-                                    if 'A' not in img_d.mode:
-                                        img_d.putalpha(255)
-                                    if 'A' not in img_g.mode:
-                                        img_g.putalpha(255)
-                                    if img_d.size != img_g.size:
-                                        img_d = img_d.resize(img_g.size, resample=Image.BILINEAR)
-                                    fname_glow = os.path.join('generated', inputs['_g']).replace('\\', '/')
-                                    inputs['_g'] = fname_glow
-                                    os.makedirs(os.path.dirname(fname_glow), exist_ok=True)
-                                    write_dds(fname_glow, ImageChops.multiply(img_d, img_g))
-                                    generated += 1
-
-                        # Write material to USDA
-                        f.write('\t\tover "mat_' + diffuse_hash + '"\n\t\t{\n\t\t\tover "Shader"\n\t\t\t{\n')
-                        if '_n' in inputs:
-                            # Force DX normals
-                            f.write('\t\t\t\tint inputs:encoding = 2 \n')
-                        if '_g' in inputs:
-                            # Set up emission
-                            f.write('\t\t\t\tbool inputs:enable_emission = 1 \n')
-                            f.write('\t\t\t\tfloat inputs:emissive_intensity = 10 \n')
-                        # Write texture inputs
-                        f.write('\t\t\t\tasset inputs:diffuse_texture = @' + diffuse_path + '@ \n')
-                        for ext in inputs:
-                            if ext == 'reflect':
-                                f.write(f'\t\t\t\tasset inputs:reflectionroughness_texture = @' + inputs[ext] + '@ \n')
-                            elif ext in extensions:
-                                f.write(f'\t\t\t\tasset inputs:{extensions[ext]} = @' + inputs[ext] + '@ \n')
-                        f.write('\t\t\t}\n\t\t}\n')
-        else:
-            print('Warning: No textures found')
-        # Write USDA footer
-        f.write('\t}\n}\n')
-    print(f'Wrote {materials} materials')
-    print(f'Wrote {generated} textures')
-    print(f'Used {textures} textures')
+        try:
+            hashmaps.append(hashmap.load(hashfile))
+        except ValueError as e:
+            eprint(f'Error: {e}')
+            sys.exit(1)
+    hashmaps = hashmap.HashMaps(hashmaps)
+
+    compress = args.block_compress
+    if compress and not have_numpy:
+        print('Warning: NumPy not installed, generated textures will not be block compressed')
+        compress = False
+
+    if not args.no_index:
+        hash_index = hashindex.HashIndex(args.hash_index)
+
+    if args.profile is not None and args.metrics_out is None:
+        args.metrics_out = 'metrics.json'
+    if args.metrics_out is not None and metrics.io_counters() is None:
+        print('Warning: psutil not installed, bytes read and written will not be measured')
+
+    # Watch from before the first run, so edits made during it are picked up
+    folder_watcher = None
+    if args.watch:
+        if not watcher.have_watchdog:
+            print(f'Warning: watchdog not installed, polling for changes every {args.poll_interval}s')
+        folder_watcher = watcher.FolderWatcher([txrdir] + ([args.meshes] if args.meshes is not None else []), ('.dds', '.nif'), args.poll_interval)
+
+    # The pool is kept across watch cycles
+    with ProcessPoolExecutor(args.jobs) if args.jobs > 1 else contextlib.nullcontext() as ex:
+        first_change = None
+        changed_roots = None
+        nifmap = None
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    # Each watch cycle gets its own report
+                    if args.metrics_out is not None:
+                        metrics.recorder = metrics.Metrics(args.slowest, args.profile)
+                    # Meshes are only scanned again when something under them changed, which can be a whole folder
+                    if nifmap is None or args.meshes in changed_roots:
+                        nifmap = None
+                        if args.meshes is not None:
+                            with metrics.stage('nif'):
+                                parsed, removed = update_nifcache(args.meshes, nifcache, ex)
+                                if parsed or removed or legacy_nifmap is not None:
+                                    # Write per-file results as json cache
+                                    print(f'Saving nif texture mapping to nifmap.json ({parsed} parsed, {removed} removed)')
+                                    with open('nifmap.json', 'w') as f:
+                                        json.dump({'nifs': nifcache}, f, indent='\t')
+                            legacy_nifmap = None
+                        nifmap = legacy_nifmap if legacy_nifmap is not None else build_nifmap(nifcache)
+                    write_usda(args, txrdir, rootdir, nifmap, hashmaps, compress, ex)
+                    if metrics.recorder is not None:
+                        report = metrics.recorder.save(args.metrics_out)
+                        for name, stage in report['stages'].items():
+                            print(metrics.format_stage(name, stage))
+                        print(f'Saved metrics to {args.metrics_out}')
+                        if report['profile'] is not None:
+                            print(f'Saved profile of {args.profile} to {report["profile"]}')
+                    end = time.perf_counter()
+                    if first_change is not None:
+                        print(f'Updated in {end - start:.2f}s, {end - first_change:.2f}s after the first change')
+                except Exception as e:
+                    if os.path.exists(args.output + '.tmp'):
+                        os.remove(args.output + '.tmp')
+                    if folder_watcher is None:
+                        raise
+                    # Keep watching, the next change tries again
+                    eprint(f'Error: {e!r}')
+
+                if folder_watcher is None:
+                    break
+                print('Watching for changes, press Ctrl+C to stop')
+                changed, changed_roots, first_change = folder_watcher.wait(args.debounce)
+                print(f'{len(changed)} files changed, updating')
+        except KeyboardInterrupt:
+            print('Stopped watching')
+        finally:
+            if folder_watcher is not None:
+                folder_watcher.close()
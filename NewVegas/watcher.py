@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+
+# Waits for files under a set of folders to change, for usdagen.py --watch
+# Uses watchdog (inotify on Linux, ReadDirectoryChangesW on Windows) if installed, otherwise polls
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    have_watchdog = True
+except:
+    have_watchdog = False
+
+# Reads by usdagen.py itself also raise events on some platforms, only count writes
+WRITE_EVENTS = ('created', 'modified', 'deleted', 'moved')
+
+class FolderWatcher:
+    def __init__(self, folders, suffixes, interval=1.0):
+        self.folders = folders
+        self.suffixes = suffixes
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.changed = set()
+        # Watched folders the changes were under
+        self.roots = set()
+        self.absolute = {folder: os.path.normcase(os.path.abspath(folder)) for folder in folders}
+        self.first_change = None
+        self.last_change = None
+        self.observer = None
+        if have_watchdog:
+            self.observer = Observer()
+            handler = FileSystemEventHandler()
+            handler.on_any_event = self.on_event
+            for folder in folders:
+                self.observer.schedule(handler, folder, recursive=True)
+            self.observer.start()
+        else:
+            self.snapshot = self.scan()
+
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def on_event(self, event):
+        if event.event_type not in WRITE_EVENTS:
+            return
+        # A folder being moved or deleted changes every file in it
+        if event.is_directory and event.event_type not in ('deleted', 'moved'):
+            return
+        paths = [os.fsdecode(path) for path in (event.src_path, getattr(event, 'dest_path', '')) if path]
+        self.add([path for path in paths if event.is_directory or self.matches(path)])
+
+    def matches(self, path):
+        return path.lower().endswith(self.suffixes)
+
+    def roots_of(self, path):
+        path = os.path.normcase(os.path.abspath(path))
+        return {folder for folder, root in self.absolute.items() if path == root or path.startswith(root + os.sep)}
+
+    def add(self, paths):
+        if not paths:
+            return
+        now = time.perf_counter()
+        roots = set().union(*map(self.roots_of, paths))
+        with self.lock:
+            self.changed.update(paths)
+            self.roots.update(roots)
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.wakeup.set()
+
+    def scan(self):
+        # Size and mtime of every watched file
+        snapshot = {}
+        stack = list(self.folders)
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif self.matches(entry.name):
+                            st = entry.stat()
+                            snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                # Deleted while scanning, the next scan sees it
+                pass
+        return snapshot
+
+    def poll(self):
+        snapshot = self.scan()
+        self.add([path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)])
+        self.snapshot = snapshot
+
+    def wait(self, debounce):
+        """Block until files changed and then stayed unchanged for debounce seconds. Returns the changed paths,
+        the watched folders they were under, as passed in, and the time.perf_counter() of the first change."""
+        while True:
+            if self.observer is None:
+                self.poll()
+            with self.lock:
+                if self.changed:
+                    quiet = time.perf_counter() - self.last_change
+                    if quiet >= debounce:
+                        changed, roots, first_change = self.changed, self.roots, self.first_change
+                        self.changed = set()
+                        self.roots = set()
+                        self.first_change = None
+                        return changed, roots, first_change
+                    timeout = debounce - quiet
+                else:
+                    timeout = None
+                self.wakeup.clear()
+            if self.observer is None:
+                time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+            else:
+                self.wakeup.wait(timeout)
@@ -0,0 +1,122 @@
+import struct
+import zlib
+from collections import namedtuple
+
+# Minimal reader for Bethesda BSA archives (v103 Oblivion, v104 Fallout 3/New Vegas)
+# Entries are decompressed on demand, so only the bytes actually read are inflated
+
+ARCHIVE_DIR_NAMES = 0x1
+ARCHIVE_FILE_NAMES = 0x2
+ARCHIVE_COMPRESSED = 0x4
+ARCHIVE_EMBED_NAMES = 0x100
+
+FILE_SIZE_MASK = 0x3FFFFFFF
+FILE_COMPRESS_TOGGLE = 0x40000000
+
+CHUNK_SIZE = 1 << 16
+
+BSAEntry = namedtuple('BSAEntry', ['archive', 'name', 'offset', 'size', 'compressed'])
+
+class BSAArchive:
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        with open(path, 'rb') as f:
+            header = f.read(36)
+            if len(header) != 36 or header[0:4] != b'BSA\0':
+                raise ValueError(f'{path}: Not a BSA archive')
+            version, offset, self.flags, folder_count, file_count, _, names_len, _ = struct.unpack('<8I', header[4:36])
+            if version not in (103, 104):
+                raise ValueError(f'{path}: Unsupported BSA version {version}')
+            if not self.flags & ARCHIVE_DIR_NAMES or not self.flags & ARCHIVE_FILE_NAMES:
+                raise ValueError(f'{path}: BSA does not include file names')
+            self.embed_names = version == 104 and bool(self.flags & ARCHIVE_EMBED_NAMES)
+
+            # Folder records: hash, file count, offset
+            f.seek(offset)
+            folders = [struct.unpack('<QII', f.read(16))[1] for _ in range(folder_count)]
+
+            # File record blocks: folder name, then hash, size, offset for each file
+            records = []
+            for count in folders:
+                name_len = f.read(1)[0]
+                folder = f.read(name_len).rstrip(b'\0').decode('cp1252')
+                for _ in range(count):
+                    _, size, data_offset = struct.unpack('<QII', f.read(16))
+                    records.append((folder, size, data_offset))
+
+            # File name block, in the same order as the file records
+            names = f.read(names_len).split(b'\0')[:file_count]
+            if len(names) != file_count:
+                raise ValueError(f'{path}: Truncated file name block')
+
+        default_compressed = bool(self.flags & ARCHIVE_COMPRESSED)
+        for (folder, size, data_offset), name in zip(records, names):
+            compressed = default_compressed != bool(size & FILE_COMPRESS_TOGGLE)
+            self.entries.append(BSAEntry(self, folder + '\\' + name.decode('cp1252'), data_offset, size & FILE_SIZE_MASK, compressed))
+
+    def files(self):
+        return self.entries
+
+    def open(self, entry):
+        return BSAEntryReader(self.path, entry, self.embed_names)
+
+class BSAEntryReader:
+    """Read-only stream over a single archive entry, inflating compressed data only as far as it is read."""
+
+    def __init__(self, path, entry, embed_names):
+        self.file = open(path, 'rb')
+        self.file.seek(entry.offset)
+        self.remaining = entry.size
+        if embed_names:
+            name_len = self.file.read(1)[0]
+            self.file.seek(name_len, 1)
+            self.remaining -= name_len + 1
+        self.inflater = None
+        if entry.compressed:
+            self.file.seek(4, 1) # Uncompressed size
+            self.remaining -= 4
+            self.inflater = zlib.decompressobj()
+        self.buffer = b''
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def tell(self):
+        return self.pos
+
+    def read_raw(self, size):
+        data = self.file.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def read(self, size):
+        if self.inflater is None:
+            data = self.read_raw(size)
+        else:
+            data = self.buffer
+            while len(data) < size:
+                if self.inflater.unconsumed_tail:
+                    chunk = self.inflater.unconsumed_tail
+                else:
+                    chunk = self.read_raw(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                data += self.inflater.decompress(chunk, size - len(data))
+            self.buffer = data[size:]
+            data = data[:size]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset):
+        # Forward only, skip over the bytes in between
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, CHUNK_SIZE)):
+                break
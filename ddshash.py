@@ -0,0 +1,136 @@
+import xxhash
+
+# Only the header and the first mipmap of a DDS are needed to compute its hash,
+# read just those bytes rather than the whole file with every mip level
+
+DDS_HEADER_SIZE = 128
+DX10_HEADER_SIZE = 20
+CHUNK_SIZE = 1 << 20
+
+# Bytes per 4x4 block for block compressed FourCC formats
+fourcc_block_sizes = {
+b'DXT1': 8,
+b'DXT2': 16,
+b'DXT3': 16,
+b'DXT4': 16,
+b'DXT5': 16,
+b'ATI1': 8,
+b'BC4U': 8,
+b'BC4S': 8,
+b'ATI2': 16,
+b'BC5U': 16,
+b'BC5S': 16
+}
+
+# Bits per pixel for D3DFMT values stored in the FourCC field
+d3dfmt_bit_counts = {
+36: 64, # A16B16G16R16
+110: 64, # Q16W16V16U16
+111: 16, # R16F
+112: 32, # G16R16F
+113: 64, # A16B16G16R16F
+114: 32, # R32F
+115: 64, # G32R32F
+116: 128 # A32B32G32R32F
+}
+
+# Bytes per 4x4 block for block compressed DXGI formats
+dxgi_block_sizes = {}
+for fmt in range(70, 73): # BC1
+    dxgi_block_sizes[fmt] = 8
+for fmt in range(73, 79): # BC2, BC3
+    dxgi_block_sizes[fmt] = 16
+for fmt in range(79, 82): # BC4
+    dxgi_block_sizes[fmt] = 8
+for fmt in range(82, 85): # BC5
+    dxgi_block_sizes[fmt] = 16
+for fmt in range(94, 100): # BC6H, BC7
+    dxgi_block_sizes[fmt] = 16
+
+# Bits per pixel for uncompressed DXGI formats
+dxgi_bit_counts = {}
+for first, last, bits in (
+        (1, 4, 128), # R32G32B32A32
+        (5, 8, 96), # R32G32B32
+        (9, 22, 64), # R16G16B16A16, R32G32, R32G8X24
+        (23, 47, 32), # R10G10B10A2, R11G11B10, R8G8B8A8, R16G16, R32, R24G8
+        (48, 59, 16), # R8G8, R16
+        (60, 65, 8), # R8, A8
+        (67, 69, 32), # R9G9B9E5, R8G8_B8G8, G8R8_G8B8
+        (85, 86, 16), # B5G6R5, B5G5R5A1
+        (87, 93, 32), # B8G8R8A8, B8G8R8X8, R10G10B10_XR_BIAS_A2
+        (115, 115, 16)): # B4G4R4A4
+    for fmt in range(first, last+1):
+        dxgi_bit_counts[fmt] = bits
+
+
+def block_size(width, height, block_bytes):
+    return max(1, (width+3)//4) * max(1, (height+3)//4) * block_bytes
+
+def top_mip_range(header):
+    """Return (offset, size) of the first mipmap given at least the first 148 bytes of a DDS, or None if not a DDS."""
+    if len(header) < DDS_HEADER_SIZE or header[0:4] != b'DDS ':
+        return None
+
+    # Extract info from the DDS header
+    dwHeight = int.from_bytes(header[12:16], 'little')
+    dwWidth  = int.from_bytes(header[16:20], 'little')
+    pfFlags  = int.from_bytes(header[80:84], 'little')
+    pfFourCC = header[84:88]
+    bitCount = int.from_bytes(header[88:92], 'little')
+
+    # Calculate mipmap size
+    offset = DDS_HEADER_SIZE
+    mipsize = dwWidth*dwHeight
+    if pfFlags & 0x4: # DDPF_FOURCC
+        if pfFourCC == b'DX10':
+            if len(header) < DDS_HEADER_SIZE + DX10_HEADER_SIZE:
+                return None
+            offset += DX10_HEADER_SIZE
+            dxgiFormat = int.from_bytes(header[128:132], 'little')
+            if dxgiFormat in dxgi_block_sizes:
+                mipsize = block_size(dwWidth, dwHeight, dxgi_block_sizes[dxgiFormat])
+            elif dxgiFormat in dxgi_bit_counts:
+                mipsize = mipsize*dxgi_bit_counts[dxgiFormat]//8
+        elif pfFourCC in fourcc_block_sizes:
+            mipsize = block_size(dwWidth, dwHeight, fourcc_block_sizes[pfFourCC])
+        else:
+            d3dfmt = int.from_bytes(pfFourCC, 'little')
+            if d3dfmt in d3dfmt_bit_counts:
+                mipsize = mipsize*d3dfmt_bit_counts[d3dfmt]//8
+    elif pfFlags & 0x20242: # DDPF_ALPHA | DDPF_RGB | DDPF_YUV | DDPF_LUMINANCE
+        mipsize = mipsize*bitCount//8
+
+    return offset, mipsize
+
+def hash_stream(file):
+    """Hash the first mipmap of an open DDS file, returns the xxh3_64 as an int or None if not a DDS."""
+    header = file.read(DDS_HEADER_SIZE + DX10_HEADER_SIZE)
+    mip = top_mip_range(header)
+    if mip is None:
+        return None
+    offset, remaining = mip
+
+    # Stream the first mipmap into the hasher in bounded chunks
+    hasher = xxhash.xxh3_64()
+    if offset < len(header):
+        data = header[offset:offset+remaining]
+        hasher.update(data)
+        remaining -= len(data)
+    else:
+        file.seek(offset)
+    while remaining > 0:
+        data = file.read(min(remaining, CHUNK_SIZE))
+        if not data:
+            break
+        hasher.update(data)
+        remaining -= len(data)
+    return hasher.intdigest()
+
+def hash_file(file_path):
+    """Hash the first mipmap of a DDS file, returns the xxh3_64 as an int or None if not a DDS."""
+    with open(file_path, 'rb') as file:
+        return hash_stream(file)
+
+def format_hash(value):
+    return f'{value:016X}'
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import ddshash
+from contextlib import closing
+
+# Persistent cache of DDS hashes keyed on (path, size, mtime_ns), shared by
+# xxhash-txrmap.py and usdagen.py so unchanged files are never rehashed
+
+def normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+class HashIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.entries = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.hits = 0
+        self.misses = 0
+        with closing(sqlite3.connect(db_path)) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+            for path, size, mtime_ns, hash_value in db.execute('SELECT path, size, mtime_ns, hash FROM hashes'):
+                self.entries[path] = (size, mtime_ns, int(hash_value, 16))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, file_path, st=None):
+        """Return the cached hash if the file is unchanged since it was indexed, otherwise None."""
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+        entry = self.entries.get(normpath(file_path))
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        return None
+
+    def store(self, file_path, hash_value, st=None):
+        if st is None:
+            st = os.stat(file_path)
+        key = normpath(file_path)
+        self.entries[key] = (st.st_size, st.st_mtime_ns, hash_value)
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def hash_file(self, file_path):
+        """Hash a DDS through the index, only reading the file if it changed."""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        hash_value = self.lookup(file_path, st)
+        if hash_value is None:
+            hash_value = ddshash.hash_file(file_path)
+            if hash_value is not None:
+                self.store(file_path, hash_value, st)
+        return hash_value
+
+    def prune(self, root, present):
+        """Drop entries under root for files not in present, returns how many were removed."""
+        prefix = os.path.join(normpath(root), '')
+        present = {normpath(path) for path in present}
+        stale = [key for key in self.entries if key.startswith(prefix) and key not in present]
+        for key in stale:
+            del self.entries[key]
+            self.dirty.discard(key)
+            self.deleted.add(key)
+        return len(stale)
+
+    def clear(self):
+        self.deleted.update(self.entries)
+        self.entries.clear()
+        self.dirty.clear()
+
+    def save(self):
+        if not self.dirty and not self.deleted:
+            return
+        with closing(sqlite3.connect(self.db_path)) as db:
+            with db:
+                db.executemany('DELETE FROM hashes WHERE path = ?', ((key,) for key in self.deleted))
+                db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                    ((key,) + self.entries[key][:2] + (ddshash.format_hash(self.entries[key][2]),) for key in self.dirty))
+        self.dirty.clear()
+        self.deleted.clear()
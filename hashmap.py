@@ -0,0 +1,219 @@
+import os
+import sys
+import mmap
+import heapq
+import struct
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Binary texture hash map, memory mapped so loading costs nothing and lookups only touch a few pages
+# Layout, little endian:
+#   header        magic, version, entry count, string table size
+#   path_hashes   u64 hash of each entry, entries are sorted by path
+#   hashes        u64 every hash, sorted
+#   hash_entries  u32 entry index of each sorted hash
+#   offsets       u32 start of each entry's path in the string table, plus the end
+#   strings       normalized UTF-8 paths, each stored once
+
+MAGIC = b'TXHM'
+VERSION = 1
+HEADER = struct.Struct('<4sIIQ')
+
+def normpath(path):
+    # Same as usdagen.py's relpathstd
+    return os.path.relpath(path, '').lower().replace('\\', '/')
+
+def is_binary(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_text(fname):
+    """Yield (path, hash) from a text hash map like texhashes.txt, raises ValueError on malformed lines."""
+    with open(fname) as f:
+        for line in f:
+            parts = line.split(' ', 1)
+            if len(parts) != 2 or len(parts[0]) != 18 or not parts[0].lower().startswith('0x'):
+                raise ValueError(f'Malform texture hash line: {line}')
+            yield normpath(parts[1].rstrip()), int(parts[0], 16)
+
+def write_sorted(fname, entries):
+    """Write a binary hash map from (path, hash) pairs that are normalized, unique and sorted by path."""
+    path_hashes = array('Q')
+    offsets = array('I', [0])
+    strings = bytearray()
+    for path, hash_value in entries:
+        path_hashes.append(hash_value)
+        strings += path.encode('utf-8')
+        offsets.append(len(strings))
+    hash_entries = array('I', sorted(range(len(path_hashes)), key=path_hashes.__getitem__))
+    hashes = array('Q', (path_hashes[i] for i in hash_entries))
+    if sys.byteorder != 'little':
+        for values in (path_hashes, hashes, hash_entries, offsets):
+            values.byteswap()
+    with open(fname, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(path_hashes), len(strings)))
+        for values in (path_hashes, hashes, hash_entries, offsets):
+            values.tofile(f)
+        f.write(strings)
+
+def write(fname, entries):
+    """Write a binary hash map from (path, hash) pairs in any order, later pairs win for the same path."""
+    entries = sorted((normpath(path), i, hash_value) for i, (path, hash_value) in enumerate(entries))
+    write_sorted(fname, unique_last(entries))
+
+def unique_last(entries):
+    # Entries sorted by path then order, keep the last of each path
+    previous = None
+    for entry in entries:
+        if previous is not None and previous[0] != entry[0]:
+            yield previous[0], previous[-1]
+        previous = entry
+    if previous is not None:
+        yield previous[0], previous[-1]
+
+class HashMap:
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, strings_size = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f'{fname}: Not a version {VERSION} texture hash map')
+        if sys.byteorder != 'little':
+            self.mm.close()
+            raise ValueError(f'{fname}: Hash maps can only be mapped on little endian machines')
+        if len(self.mm) != HEADER.size + count * 24 + 4 + strings_size:
+            self.mm.close()
+            raise ValueError(f'{fname}: Truncated texture hash map')
+
+        # Views straight into the mapping, nothing is copied
+        self.view = memoryview(self.mm)
+        offset = HEADER.size
+        sections = []
+        for size, fmt in ((count * 8, 'Q'), (count * 8, 'Q'), (count * 4, 'I'), ((count + 1) * 4, 'I')):
+            sections.append(self.view[offset:offset+size].cast(fmt))
+            offset += size
+        self.path_hashes, self.hashes, self.hash_entries, self.offsets = sections
+        self.strings = self.view[offset:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for view in (self.path_hashes, self.hashes, self.hash_entries, self.offsets, self.strings, self.view):
+            view.release()
+        self.mm.close()
+
+    def __len__(self):
+        return len(self.path_hashes)
+
+    def path_bytes(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def path(self, i):
+        return self.path_bytes(i).decode('utf-8')
+
+    def get(self, path):
+        """Hash of a normalized path, or None."""
+        key = path.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.path_bytes(lo) == key:
+            return self.path_hashes[lo]
+        return None
+
+    def paths(self, hash_value):
+        """Every path with the given hash."""
+        start = bisect_left(self.hashes, hash_value)
+        end = bisect_right(self.hashes, hash_value, start)
+        return [self.path(self.hash_entries[i]) for i in range(start, end)]
+
+    def items(self):
+        """(path, hash) pairs sorted by path."""
+        for i in range(len(self)):
+            yield self.path(i), self.path_hashes[i]
+
+class HashMaps:
+    """Several maps looked up as one, later maps win for the same path like loading them in order."""
+
+    def __init__(self, hashmaps):
+        self.hashmaps = hashmaps
+
+    def get(self, path):
+        for hashmap in reversed(self.hashmaps):
+            hash_value = hashmap.get(path)
+            if hash_value is not None:
+                return hash_value
+        return None
+
+    def paths(self, hash_value):
+        result = []
+        for hashmap in self.hashmaps:
+            if isinstance(hashmap, HashMap):
+                result.extend(hashmap.paths(hash_value))
+            else:
+                result.extend(path for path, value in hashmap.items() if value == hash_value)
+        # Skip paths a later map gave a different hash
+        return [path for path in dict.fromkeys(result) if self.get(path) == hash_value]
+
+def load(fname):
+    """Open a binary map, or read a text map into a dict."""
+    if is_binary(fname):
+        return HashMap(fname)
+    return dict(read_text(fname))
+
+def sorted_items(hashmap):
+    if isinstance(hashmap, HashMap):
+        return hashmap.items()
+    return iter(sorted(hashmap.items()))
+
+def tagged_items(hashmap, order):
+    for path, hash_value in sorted_items(hashmap):
+        yield path, order, hash_value
+
+def merge(fname, hashmaps):
+    """Merge maps into one binary map, later maps win for the same path.
+    Binary maps are already sorted, so they are streamed rather than loaded."""
+    streams = [tagged_items(hashmap, order) for order, hashmap in enumerate(hashmaps)]
+    write_sorted(fname, unique_last(heapq.merge(*streams)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Looks up and merges texture hash maps.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    lookup = subparsers.add_parser('lookup', help='Look up paths by hash, or hashes by path')
+    lookup.add_argument('maps', help='Comma separated hash maps, later maps win for the same path')
+    lookup.add_argument('queries', help='Hashes (0x...) or texture paths', nargs='+')
+    merger = subparsers.add_parser('merge', help='Merge text or binary hash maps into one binary map')
+    merger.add_argument('output', help='The binary hash map to write')
+    merger.add_argument('maps', help='Hash maps to merge, later maps win for the same path', nargs='+')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'merge':
+            hashmaps = [load(fname) for fname in args.maps]
+            merge(args.output, hashmaps)
+            with HashMap(args.output) as hashmap:
+                print(f'Wrote {len(hashmap)} entries to {args.output}')
+        else:
+            hashmaps = HashMaps([load(x.strip()) for x in args.maps.split(',')])
+            for query in args.queries:
+                if query.lower().startswith('0x'):
+                    paths = hashmaps.paths(int(query, 16))
+                    print(f'{query}: {", ".join(paths) if paths else "not found"}')
+                else:
+                    path = normpath(query)
+                    hash_value = hashmaps.get(path)
+                    print(f'{path}: {"not found" if hash_value is None else f"0x{hash_value:016X}"}')
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}')
+        sys.exit(1)
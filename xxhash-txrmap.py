@@ -1,49 +1,138 @@
 import os
 import sys
-import xxhash
+import time
+import argparse
+import contextlib
+import bsa
+import ddshash
+import hashindex
+import hashmap
+from concurrent.futures import ThreadPoolExecutor
 
 def calculate_DDS_hash(file_path):
-    with open(file_path, 'rb') as file:
-        data = file.read()
-
-    # Extract info from the DDS header
-    if data[0:4] != b'DDS ':
-        print(f'Warning: {file_path}: Missing DDS header')
-        return None
-    dwHeight = int.from_bytes(data[12:16], "little")
-    dwWidth  = int.from_bytes(data[16:20], "little")
-    pfFlags  = int.from_bytes(data[80:84], "little")
-    pfFourCC = data[84:88]
-    bitCount = int.from_bytes(data[88:92], "little")
-
-    # Calculate mipmap size
-    mipsize = dwWidth*dwHeight
-    if pfFlags & 0x4: # DDPF_FOURCC
-        if pfFourCC == b'DXT1': # DXT1 is 4bpp
-            mipsize //= 2
-    elif pfFlags & 0x20242: # DDPF_ALPHA | DDPF_RGB | DDPF_YUV | DDPF_LUMINANCE
-        mipsize = mipsize*bitCount//8
-
-    # Calculate hash of the first mipmap
-    return "0x" + xxhash.xxh3_64(data[128:128+mipsize]).hexdigest().upper()
+    # Only the header and first mipmap are read, also returns how many bytes that was
+    # Archive entries are only decompressed as far as the first mipmap
+    if isinstance(file_path, bsa.BSAEntry):
+        file = file_path.archive.open(file_path)
+    else:
+        file = open(file_path, 'rb')
+    with file:
+        hash_value = ddshash.hash_stream(file)
+        size = file.tell()
+    if hash_value is None:
+        return None, size
+    return "0x" + ddshash.format_hash(hash_value), size
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print(f'Usage: {sys.argv[0]} textures_folder output_hashes')
+    parser = argparse.ArgumentParser(description='Generates a mapping of texture hashes to texture paths.')
+    parser.add_argument('sources', help='The textures folders or BSA archives to search through', nargs='+')
+    parser.add_argument('output_hashes', help='The hash mapping list to write')
+    parser.add_argument('-b', '--binary', help='Also write a memory mapped binary hash map for usdagen.py and hashmap.py')
+    parser.add_argument('-j', '--jobs', help='Number of files to hash in parallel', type=int, default=1)
+    parser.add_argument('-i', '--index', help='Hash index to reuse hashes of unchanged files from', default='hashindex.db')
+    parser.add_argument('-ni', '--no-index', help="Don't read or update the hash index", action='store_true')
+    parser.add_argument('--rebuild', help='Discard the hash index and hash every file again', action='store_true')
+    parser.add_argument('--verify', help='Hash every file again and report index entries that were wrong', action='store_true')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        print(f'Error: --jobs must be at least 1')
         sys.exit(1)
 
-    folder_path = sys.argv[1]
-    output_file_path = sys.argv[2]
+    folders = []
+    archives = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            folders.append(source)
+        elif os.path.isfile(source) and source.lower().endswith('.bsa'):
+            try:
+                archives.append(bsa.BSAArchive(source))
+            except (OSError, ValueError) as e:
+                print(f'Error: {e}')
+                sys.exit(1)
+        else:
+            print(f'Error: {source}: Not a directory or BSA archive')
+            sys.exit(1)
+    output_file_path = args.output_hashes
 
-    with open(output_file_path, 'w') as output_file:
-        # Recursively iterate over all files in the folder
+    # Recursively gather all DDS files in the folders, sorted so output is stable
+    ddslist = []
+    for folder_path in folders:
         for root, dirs, files in os.walk(folder_path):
             for file_name in files:
                 file_path = os.path.join(root, file_name)
 
                 # Check if the file is a DDS file
                 if file_name.lower().endswith('.dds') and os.path.isfile(file_path):
-                    # Generate the hash for the DDS file
-                    hash_value = calculate_DDS_hash(file_path)
-                    if hash_value is not None:
-                        output_file.write(f"{hash_value} {file_path}\n")
+                    ddslist.append(file_path)
+    ddslist.sort()
+
+    # Archives are hashed straight from their entries without extracting
+    bsalist = []
+    for archive in archives:
+        bsalist.extend(sorted((entry for entry in archive.files() if entry.name.lower().endswith('.dds')), key=lambda entry: entry.name.lower()))
+
+    start = time.perf_counter()
+
+    # Reuse hashes of files whose size and mtime are unchanged
+    index = None
+    stats = {}
+    cached = {}
+    if not args.no_index:
+        index = hashindex.HashIndex(args.index)
+        if args.rebuild:
+            index.clear()
+        for file_path in ddslist:
+            stats[file_path] = os.stat(file_path)
+            if not args.verify:
+                hash_value = index.lookup(file_path, stats[file_path])
+                if hash_value is not None:
+                    cached[file_path] = "0x" + ddshash.format_hash(hash_value)
+    misses = [file_path for file_path in ddslist if file_path not in cached] + bsalist
+
+    total_bytes = 0
+    mismatched = 0
+    entries = []
+    with open(output_file_path, 'w') as output_file:
+        # xxhash releases the GIL, threads are enough to keep several cores busy
+        with ThreadPoolExecutor(args.jobs) if args.jobs > 1 else contextlib.nullcontext() as ex:
+            # Results come back in submission order, write them as they arrive
+            mapper = ex.map if ex is not None else map
+            hashed = mapper(calculate_DDS_hash, misses)
+            for file_path in ddslist + bsalist:
+                if file_path in cached:
+                    hash_value = cached[file_path]
+                else:
+                    hash_value, size = next(hashed)
+                    total_bytes += size
+                    if isinstance(file_path, bsa.BSAEntry):
+                        file_path = file_path.name
+                    elif index is not None and hash_value is not None:
+                        if args.verify:
+                            old_value = index.lookup(file_path, stats[file_path])
+                            if old_value is not None and "0x" + ddshash.format_hash(old_value) != hash_value:
+                                print(f'Warning: {file_path}: Index had 0x{ddshash.format_hash(old_value)}, actual hash is {hash_value}')
+                                mismatched += 1
+                        index.store(file_path, int(hash_value, 16), stats[file_path])
+                if hash_value is not None:
+                    output_file.write(f"{hash_value} {file_path}\n")
+                    if args.binary is not None:
+                        entries.append((file_path, int(hash_value, 16)))
+                else:
+                    print(f'Warning: {file_path}: Missing DDS header')
+
+    if args.binary is not None:
+        hashmap.write(args.binary, entries)
+        print(f'Wrote binary hash map {args.binary}')
+
+    if index is not None:
+        # Forget files that were deleted since the last run
+        pruned = sum(index.prune(folder_path, ddslist) for folder_path in folders)
+        index.save()
+        print(f'Reused {len(cached)} hashes from {args.index}, pruned {pruned} stale entries')
+        if args.verify:
+            print(f'Verified {len(misses)} files, {mismatched} index entries were wrong')
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    print(f'Hashed {len(misses)} files ({total_bytes / 1e6:.1f} MB) in {elapsed:.2f}s using {args.jobs} job(s): '
+          f'{len(misses) / elapsed:.1f} files/s, {total_bytes / 1e6 / elapsed:.1f} MB/s')